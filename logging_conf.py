@@ -1,21 +1,327 @@
 # -*- coding: utf8 -*-
 """
 Logging configuration
+
+Records are put in a queue by the logging thread and written to the log file
+in batches by a background thread, so logging doesn't block on file I/O.
+
+With structured=True each record is written as a JSON line:
+
+    {"time": "...", "level": "ERROR", "logger": "logger_err",
+     "message": "Insert exception", "fpath": "/path/img_0001.jpg",
+     "exc_type": "PhotoException", "exc_message": "...", "traceback": "..."}
+
+Repeated identical records can be limited with max_repeats. See RepeatFilter.
+
+Byte strings which are not UTF-8, like some file paths, are written with the
+invalid bytes replaced, so the record is never lost.
 """
+import os
+import sys
+import json
+import time
+import Queue
+import atexit
 import logging
+import threading
+import traceback
+
+
+LOG_DIR = 'log'
 
+# Records written per batch and maximum seconds a record waits in the queue.
+LOG_BATCH_SIZE = 256
+LOG_FLUSH_INTERVAL = 1.0
 
-def logger_factory(logger_name, level=logging.DEBUG, propagate=False):
+# Default repeated records limit. See RepeatFilter.
+LOG_REPEAT_WINDOW = 60.0
+LOG_TRACEBACK_LIMIT = 1
 
+# Attributes of a LogRecord which are not extra fields.
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None)))
+_RECORD_ATTRS.update(['message', 'asctime'])
+
+# Background writers by logger name. See logger_factory.
+_listeners = {}
+_listeners_lock = threading.Lock()
+
+
+def logger_factory(logger_name, level=logging.DEBUG, propagate=False,
+                   log_dir=LOG_DIR, queued=True, structured=True,
+                   max_repeats=None, repeat_window=LOG_REPEAT_WINDOW,
+                   max_tracebacks=LOG_TRACEBACK_LIMIT):
+    """Configure the logger to write to <log_dir>/<logger_name>.log
+
+    Calling it again for an already configured logger does nothing.
+
+    :param queued: bool. Write from a background thread in batches.
+    :param structured: bool. Write JSON lines instead of text lines.
+    :param max_repeats: int. Optional. Maximum repeated records logged per
+        repeat_window seconds. See RepeatFilter.
+    :param max_tracebacks: int. Repeated records logged with traceback.
+    """
     logger = logging.getLogger(logger_name)
 
-    formatter = logging.Formatter(
-        fmt='[%(levelname)s] %(asctime)s - %(filename)s (%(lineno)d): %(message)s ',
-        datefmt='%m/%d/%Y %H:%M:%S')
+    with _listeners_lock:
+        if logger_name in _listeners:
+            return logger
+
+        if structured:
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(
+                fmt='[%(levelname)s] %(asctime)s - %(filename)s (%(lineno)d): '
+                    '%(message)s ',
+                datefmt='%m/%d/%Y %H:%M:%S')
+
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        fpath = os.path.join(log_dir, logger_name + '.log')
+
+        if queued:
+            listener = BatchQueueListener(fpath, formatter)
+            listener.start()
+            handler = QueueHandler(listener.queue, formatter)
+        else:
+            listener = None
+            handler = logging.FileHandler(fpath)
+            handler.setFormatter(formatter)
+
+        if max_repeats is not None:
+            handler.addFilter(RepeatFilter(
+                max_repeats, window=repeat_window,
+                max_tracebacks=max_tracebacks))
+
+        logger.setLevel(level)
+        logger.addHandler(handler)
+        logger.propagate = propagate
+        _listeners[logger_name] = listener
+
+    return logger
+
+
+def shutdown():
+    """Write all queued records and stop the background writers."""
+    with _listeners_lock:
+        for listener in _listeners.values():
+            if listener is not None:
+                listener.stop()
+
+
+atexit.register(shutdown)
+
+
+class QueueHandler(logging.Handler):
+    """Put records in a queue to be written by a BatchQueueListener.
+
+    The record is prepared in the calling thread: message arguments are merged
+    and the traceback is rendered as text, so the queued record doesn't keep
+    references to the exception and its frames.
+    """
+    def __init__(self, queue, formatter):
+        logging.Handler.__init__(self)
+        self.queue = queue
+        self.setFormatter(formatter)
+
+    def prepare(self, record):
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            exc_type, exc_value = record.exc_info[:2]
+            record.exc_type = exc_type.__name__
+            record.exc_message = _exc_message(exc_value)
+            record.exc_text = self.formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Exception:
+            self.handleError(record)
+
+
+class BatchQueueListener(object):
+    """Write records from a queue to a file in batches.
+
+    A batch is written with a single write and flush, when LOG_BATCH_SIZE
+    records are queued or LOG_FLUSH_INTERVAL seconds after its first record.
+    """
+    _STOP = object()
+
+    def __init__(self, fpath, formatter, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL):
+        self.queue = Queue.Queue()
+        self.__fpath = fpath
+        self.__formatter = formatter
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__thread = None
+
+    def start(self):
+        self.__thread = threading.Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def stop(self):
+        if self.__thread is not None:
+            self.queue.put(self._STOP)
+            self.__thread.join()
+            self.__thread = None
+
+    def __run(self):
+        with open(self.__fpath, 'a') as stream:
+            stop = False
+            while not stop:
+                batch = [self.queue.get()]
+                deadline = time.time() + self.__flush_interval
+                while len(batch) < self.__batch_size:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        batch.append(self.queue.get(timeout=timeout))
+                    except Queue.Empty:
+                        break
+
+                lines = []
+                for record in batch:
+                    if record is self._STOP:
+                        stop = True
+                        continue
+                    try:
+                        lines.append(self.__formatter.format(record) + '\n')
+                    except Exception:
+                        traceback.print_exc(file=sys.stderr)
+                if lines:
+                    stream.write(''.join(lines))
+                    stream.flush()
+
+            # Drain records put before stop.
+            lines = []
+            while True:
+                try:
+                    record = self.queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if record is self._STOP:
+                    continue
+                try:
+                    lines.append(self.__formatter.format(record) + '\n')
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+            if lines:
+                stream.write(''.join(lines))
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as JSON lines.
+
+    Extra attributes given with logger.info(msg, extra={...}) are included.
+    """
+    def format(self, record):
+        data = {
+            'time': time.strftime(
+                '%Y-%m-%dT%H:%M:%S', time.localtime(record.created)),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'source': '{}:{}'.format(record.filename, record.lineno),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc_type'] = record.exc_info[0].__name__
+            data['exc_message'] = _exc_message(record.exc_info[1])
+            data['traceback'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['traceback'] = record.exc_text
+        for key, value in data.items():
+            data[key] = _text(value)
+        return json.dumps(data, default=lambda obj: _text(str(obj)))
+
+
+class RepeatFilter(logging.Filter):
+    """Limit repeated identical records.
+
+    Records are identical when they have the same logger, message template and
+    exception type and message. The 'fpath' extra attribute is removed from
+    the exception message, so the same error in different files is taken as a
+    repeat, like thousands of 'Missing EXIF data' errors. Variable data, like
+    the path, has to be given in the message args or extra attributes, not
+    formatted into the message template.
+
+    Up to max_repeats identical records are logged per window seconds, and
+    only the first max_tracebacks of them keep the traceback. The first record
+    logged after some have been dropped has a 'suppressed' attribute with the
+    number of dropped records.
+    """
+    def __init__(self, max_repeats, window=LOG_REPEAT_WINDOW,
+                 max_tracebacks=LOG_TRACEBACK_LIMIT):
+        logging.Filter.__init__(self)
+        self.__max_repeats = max_repeats
+        self.__window = window
+        self.__max_tracebacks = max_tracebacks
+        self.__lock = threading.Lock()
+
+        # {key: [window start, records logged, records dropped]}
+        self.__counts = {}
+        # {key: records with traceback}
+        self.__tracebacks = {}
+
+    def __key(self, record):
+        exc_type = exc_message = None
+        if record.exc_info:
+            exc_type = record.exc_info[0].__name__
+            exc_message = _exc_message(record.exc_info[1])
+            fpath = _text(getattr(record, 'fpath', None))
+            if fpath:
+                exc_message = exc_message.replace(fpath, u'')
+        return record.name, _text(record.msg), exc_type, exc_message
+
+    def filter(self, record):
+        key = self.__key(record)
+        now = time.time()
+        with self.__lock:
+            count = self.__counts.get(key)
+            if count is None or now - count[0] >= self.__window:
+                dropped = count[2] if count is not None else 0
+                count = self.__counts[key] = [now, 0, 0]
+                if dropped:
+                    record.suppressed = dropped
+            if count[1] >= self.__max_repeats:
+                count[2] += 1
+                return False
+            count[1] += 1
+
+            if record.exc_info:
+                tracebacks = self.__tracebacks.get(key, 0)
+                if tracebacks >= self.__max_tracebacks:
+                    record.exc_type = record.exc_info[0].__name__
+                    record.exc_message = _exc_message(record.exc_info[1])
+                    record.exc_info = None
+                else:
+                    self.__tracebacks[key] = tracebacks + 1
+        return True
+
+
+def _exc_message(exc):
+    try:
+        return unicode(exc)
+    except Exception:
+        try:
+            return str(exc).decode('utf8', 'replace')
+        except Exception:
+            return _text(repr(exc))
+
 
-    file_handler = logging.FileHandler('log/' + logger_name + '.log')
-    file_handler.setFormatter(formatter)
+def _text(value):
+    """Return byte strings as unicode, replacing bytes which are not UTF-8.
 
-    logger.setLevel(level)
-    logger.addHandler(file_handler)
-    logger.propagate = propagate
\ No newline at end of file
+    Other values are returned as they are.
+    """
+    if isinstance(value, str):
+        return value.decode('utf8', 'replace')
+    return value
@@ -5,6 +5,8 @@ Photo Metadata
 - Import album
 - Describe source files paths (ha de permetre descobrir albums)
 
+Command line: python photometa.py --help
+
 EXIF info:
 - http://stackoverflow.com/questions/4764932/in-python-how-do-i-read-the-exif-data-for-an-image
 - https://www.quora.com/What-is-the-difference-between-Date-and-Time-Original-and-Date-and-Time-in-the-EXIF-data-output
@@ -26,24 +28,31 @@ EXIF info:
 """
 import os
 import re
+import sys
+import errno
 import collections
-from PIL import Image
-from PIL import ImageChops
-from PIL import ExifTags
-import hashlib
 from datetime import datetime
 import shutil
 import struct
 import logging
-import pickle
+import math
+import threading
+import Queue
+import bisect
+import time
 
-from logging_conf import logger_factory
+import logging_conf
 
+# PIL, hashlib, pickle and the log handlers are loaded when first needed, so
+# importing this module is fast and has no side effects on the file system.
 
-logger_factory('logger_err')
-logger_err = logging.getLogger('logger_err')
+# Directory of the transaction and error logs. See configure_logging.
+LOG_DIR = 'log'
 
-logger_factory('logger_trans')
+# Identical errors logged per minute. See logging_conf.RepeatFilter.
+LOG_ERROR_REPEATS = 100
+
+logger_err = logging.getLogger('logger_err')
 logger_trans = logging.getLogger('logger_trans')
 
 
@@ -56,9 +65,73 @@ logger_trans = logging.getLogger('logger_trans')
 
 BASE_PATH = "/home/sergi/Pictures"
 
+# Bytes read from the beginning of a file to compute its partial hash.
+PARTIAL_HASH_SIZE = 64 * 1024
+
+# False positive rate of the content DB membership filter.
+CONTENT_FILTER_ERROR_RATE = 0.01
+
 EXIF_DATE_CREATE_CODE = 306
 EXIF_DATE_ORIGINAL_CODE = 36867
 
+# Read size when hashing and copying files in chunks.
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Give the kernel access pattern hints (posix_fadvise) when hashing and
+# copying: read ahead sequentially and drop the source pages once copied, so
+# large imports don't evict the page cache.
+IO_HINTS = True
+
+# posix_fadvise advice values (Linux).
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# sync_file_range flag. See sync_file_range(2).
+SYNC_FILE_RANGE_WRITE = 2
+
+# File read order. See physical_order.
+IO_ORDER_WALK = 'walk'
+IO_ORDER_PHYSICAL = 'physical'
+
+# Scrub result status. See Repository.scrub.
+SCRUB_OK = 'ok'
+SCRUB_CORRUPT = 'corrupt'
+SCRUB_MISSING = 'missing'
+SCRUB_UNREADABLE = 'unreadable'
+SCRUB_UNTRACKED = 'untracked'
+SCRUB_ERROR = 'error'
+
+# Default thumbnail bounding box (width, height) and JPEG quality.
+THUMBNAIL_SIZE = (256, 256)
+THUMBNAIL_QUALITY = 85
+
+# File types PIL can build a thumbnail from.
+THUMBNAIL_FILE_TYPES = ['jpeg', 'png', 'gif', 'tiff']
+
+# EXIF tags kept in the repository catalog: (catalog field, EXIF tag name)
+CATALOG_EXIF_FIELDS = [
+    ('make', 'Make'),
+    ('model', 'Model'),
+    ('iso', 'ISOSpeedRatings'),
+    ('width', 'ExifImageWidth'),
+    ('height', 'ExifImageHeight'),
+]
+
+# How files are transferred into the repository. See Repository.insert.
+TRANSFER_COPY = 'copy'
+TRANSFER_LINK = 'link'
+TRANSFER_MOVE = 'move'
+
+# Staged commit. Files are copied to hidden temporary names with this
+# extension and renamed into place in batches of FSYNC_BATCH_SIZE files.
+STAGING_EXT = 'photometa-tmp'
+FSYNC_BATCH_SIZE = 64
+
+# Insert results kept in memory, for files inserted OK and for files with
+# errors. Counters are kept for all of them. See InsertResultSink.
+INSERT_RESULTS_SAMPLE = 1000
+
 # Permission to insert files in the repository.
 REPO_IS_LOCKED = True
 
@@ -90,33 +163,116 @@ class RepositoryManager(object):
 
     :param repository: Repository
     :param source_fm: SourceFilesManager
+    :param thumbnail_cache: ThumbnailCache. Optional. If given, a thumbnail is
+        built for every file inserted.
+    :param result_sink: InsertResultSink. Optional. Where insert results are
+        kept. By default only counters and a sample of the results.
     """
-    def __init__(self, repository, source_fm):
+    def __init__(self, repository, source_fm, thumbnail_cache=None,
+                 result_sink=None):
+        configure_logging()
         self.__repo = repository
         self.repo = repository
         self.__source_fm = source_fm
+        self.__thumbnail_cache = thumbnail_cache
 
-        # Insert results list
-        self.__insert_res = None
+        # Insert results
+        self.__insert_res = result_sink
+        if self.__insert_res is None:
+            self.__insert_res = InsertResultSink()
+        # Orders the insert result of a file and its commit error, which may
+        # come from a commit done by another thread.
+        self.__commit_lock = threading.Lock()
+
+    @property
+    def source(self):
+        return self.__source_fm
+
+    @source.setter
+    def source(self, source_fm):
+        self.__source_fm = source_fm
 
     def __insert(self, overwrite=False, alternate_names=False, dry_run=False):
 
-        self.__insert_res = []
+        self.clear_results()
 
         for source_file in self.__source_fm.files:
-            try:
-                # import pdb; pdb.set_trace()
-                self.__repo.insert(
-                    source_file, dest_path=None, overwrite=overwrite,
-                    alternate_names=alternate_names, dry_run=dry_run)
-                logger_trans.info('Insert OK {}'.format(source_file))
-                self.__insert_res.append(InsertResult(source_file))
-            except Exception, ex:
-                logger_trans.error('Insert ERROR {}'.format(source_file))
-                logger_err.exception('Insert exception')
-                self.__insert_res.append(InsertResult(source_file, exception=ex))
+            self.insert_file(source_file, overwrite=overwrite,
+                             alternate_names=alternate_names, dry_run=dry_run)
+        self.__commit()
+        if self.__thumbnail_cache is not None:
+            # Wait for the thumbnails and stop the pool workers.
+            self.__thumbnail_cache.close()
         self.report()
 
+    def __commit(self):
+        try:
+            self.__repo.commit()
+        except Exception:
+            logger_trans.error('Commit ERROR')
+            logger_err.exception('Commit exception')
+            raise
+
+    def insert_file(self, source_file, overwrite=False, alternate_names=False,
+                    dry_run=False):
+        """Insert a single source file and keep its insert result.
+
+        It never raises. Errors are logged and kept in the results. In a staged
+        repository, a file which can't be committed is changed to an error
+        when the commit is done.
+        """
+        # inserted is None until the insert result is added.
+        state = {'inserted': None, 'commit_error': None}
+        try:
+            # import pdb; pdb.set_trace()
+            self.__repo.insert(
+                source_file, dest_path=None, overwrite=overwrite,
+                alternate_names=alternate_names, dry_run=dry_run,
+                on_commit_error=self.__commit_error_callback(source_file,
+                                                             state))
+        except Exception, ex:
+            logger_trans.error('Insert ERROR %s', source_file,
+                               extra={'fpath': source_file.fpath})
+            logger_err.exception('Insert exception',
+                                 extra={'fpath': source_file.fpath})
+            with self.__commit_lock:
+                self.__insert_res.add(source_file.fpath, exception=ex)
+                state['inserted'] = False
+            return
+
+        logger_trans.info('Insert OK %s', source_file,
+                          extra={'fpath': source_file.fpath})
+        with self.__commit_lock:
+            # Committed, and failed, while it was being inserted.
+            self.__insert_res.add(source_file.fpath,
+                                  exception=state['commit_error'])
+            state['inserted'] = True
+
+        if self.__thumbnail_cache is not None and not dry_run:
+            try:
+                # Same content as the inserted file, so same thumbnail.
+                self.__thumbnail_cache.submit(
+                    source_file.fpath, source_file.hash())
+            except Exception:
+                logger_err.exception('Thumbnail exception',
+                                     extra={'fpath': source_file.fpath})
+
+    def __commit_error_callback(self, source_file, state):
+        def commit_error(ex):
+            logger_trans.error('Commit ERROR %s', source_file,
+                               extra={'fpath': source_file.fpath})
+            logger_err.error('Commit exception: %s', _exception_message(ex),
+                             extra={'fpath': source_file.fpath})
+            with self.__commit_lock:
+                if state['inserted'] is None:
+                    state['commit_error'] = ex
+                elif state['inserted']:
+                    self.__insert_res.fail(source_file.fpath, ex)
+        return commit_error
+
+    def clear_results(self):
+        self.__insert_res.clear()
+
     def insert_strict(self, dry_run=False):
         """Insert files. Raise error if a file with same name exits.
 
@@ -141,45 +297,389 @@ class RepositoryManager(object):
         self.__insert(overwrite=False, alternate_names=False, dry_run=dry_run)
 
     def report(self):
-        print 'Files to be inserted: {}'.format(len(self.__source_fm.files))
-        print 'Files inserted OK: {}'.format(len(self.files_insert_ok()))
-        print 'Files with insert ERR : {}'.format(len(self.files_insert_error()))
+        if self.__source_fm is not None:
+            print 'Files to be inserted: {}'.format(len(self.__source_fm.files))
+        print 'Files inserted OK: {}'.format(self.__insert_res.count_ok)
+        print 'Files with insert ERR : {}'.format(self.__insert_res.count_error)
 
     def results(self):
+        """InsertResultSink with the insert results."""
         return self.__insert_res
 
     def files_insert_ok(self):
-        return [ir.source_file for ir in self.__insert_res if not ir.has_error]
+        """Paths of the files inserted OK. See InsertResultSink.results."""
+        return [ir.fpath for ir in self.__insert_res.results()
+                if not ir.has_error]
 
     def files_insert_error(self):
-        return [ir.source_file for ir in self.__insert_res if ir.has_error]
+        """Paths of the files with insert error."""
+        return [ir.fpath for ir in self.__insert_res.results() if ir.has_error]
 
     def errors(self):
-        return [(ir.source_file.fpath, ir.exception)
-                for ir in self.__insert_res
+        """List of (file path, InsertError)."""
+        return [(ir.fpath, ir.error) for ir in self.__insert_res.results()
                 if ir.has_error]
 
     def errors_by_type(self):
-        errs = [type(ir.exception) for ir in self.__insert_res if ir.has_error]
-        return collections.Counter(errs)
+        """Counter of errors by exception class name, for all the files."""
+        return self.__insert_res.errors_by_type()
+
+
+class MultiSourceRepositoryManager(object):
+    """Insert photos from several sources into the repository.
+
+    Sources are grouped by the device they are stored in (st_dev) and each
+    device has its own pool of worker threads. Sources on different devices
+    (SD card readers, phones, NAS shares) are read in parallel, while the
+    number of concurrent readers on a single device is limited by its worker
+    budget, so a spinning disk is not thrashed by competing reads.
+
+    Each source has its own RepositoryManager, which keeps its results and
+    report.
+
+    Sources given as paths are loaded (the tree walked and the file headers
+    read) by the workers of their device when inserting, so loading is also
+    done in parallel across devices.
+
+    :param repository: Repository
+    :param sources: list of SourceFilesManager or source paths.
+    :param workers_per_device: int or dict {st_dev: int}. Optional. Default 1.
+        Worker threads per device. Devices not in the dict get 1 worker.
+    :param source_kwargs: dict. Optional. SourceFilesManger arguments for the
+        sources given as paths.
+    """
+    def __init__(self, repository, sources, workers_per_device=1,
+                 source_kwargs=None):
+        self.__repo = repository
+        self.__managers = []
+        # Source path of each manager.
+        self.__paths = []
+        for source in sources:
+            if isinstance(source, basestring):
+                _check_path(source)
+                self.__managers.append(RepositoryManager(repository, None))
+                self.__paths.append(source)
+            else:
+                self.__managers.append(RepositoryManager(repository, source))
+                self.__paths.append(source.path)
+        self.__workers_per_device = workers_per_device
+        self.__source_kwargs = source_kwargs or {}
+
+    @property
+    def managers(self):
+        """RepositoryManager for each source, in the given sources order."""
+        return self.__managers
+
+    def devices(self):
+        """Return {st_dev: [RepositoryManager]} for the sources."""
+        by_device = collections.OrderedDict()
+        for mng, path in zip(self.__managers, self.__paths):
+            st_dev = os.stat(path).st_dev
+            by_device.setdefault(st_dev, []).append(mng)
+        return by_device
+
+    def __device_workers(self, st_dev):
+        if isinstance(self.__workers_per_device, dict):
+            return self.__workers_per_device.get(st_dev, 1)
+        return self.__workers_per_device
+
+    def __insert(self, overwrite=False, alternate_names=False, dry_run=False):
+        kwargs = dict(overwrite=overwrite, alternate_names=alternate_names,
+                      dry_run=dry_run)
+        paths = dict(zip(self.__managers, self.__paths))
+        workers = []
+        load_errors = []
+        for st_dev, managers in self.devices().iteritems():
+            loads = Queue.Queue()
+            tasks = Queue.Queue()
+            for mng in managers:
+                mng.clear_results()
+                loads.put((mng, paths[mng]))
+
+            n_workers = max(1, self.__device_workers(st_dev))
+            # Inserts start once all the sources in the device are loaded.
+            loaded = _Barrier(n_workers)
+            for _ in xrange(n_workers):
+                worker = threading.Thread(
+                    target=self.__worker,
+                    args=(loads, loaded, tasks, kwargs, load_errors))
+                worker.daemon = True
+                worker.start()
+                workers.append(worker)
+
+        for worker in workers:
+            worker.join()
+        self.__repo.commit()
+        # The files of the sources loaded have been inserted: report them
+        # before the error.
+        self.report()
+        if load_errors:
+            raise load_errors[0]
+
+    def __worker(self, loads, loaded, tasks, kwargs, load_errors):
+        try:
+            self.__load(loads, tasks, load_errors)
+        finally:
+            # The other workers of the device are waiting for this one, even
+            # if it failed.
+            loaded.wait()
+
+        while True:
+            try:
+                mng, source_file = tasks.get_nowait()
+            except Queue.Empty:
+                return
+            mng.insert_file(source_file, **kwargs)
+
+    def __load(self, loads, tasks, load_errors):
+        """Load the sources in loads and queue their files in tasks."""
+        while True:
+            try:
+                mng, path = loads.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                if mng.source is None:
+                    mng.source = SourceFilesManger(path, **self.__source_kwargs)
+                source_files = mng.source.files
+            except Exception, ex:
+                logger_err.exception('Source load exception',
+                                     extra={'fpath': path})
+                load_errors.append(ex)
+                continue
+            for source_file in source_files:
+                tasks.put((mng, source_file))
+
+    def insert_strict(self, dry_run=False):
+        """Insert files from all sources. Raise error if a file with same name
+        exits.
+
+        See RepositoryManager.insert_strict.
+        """
+        self.__insert(overwrite=False, alternate_names=False, dry_run=dry_run)
+
+    def report(self):
+        for mng, path in zip(self.__managers, self.__paths):
+            print 'Source: {}'.format(path)
+            mng.report()
+
+
+class _Barrier(object):
+    """Wait until parties threads have called wait."""
+    def __init__(self, parties):
+        self.__waiting = parties
+        self.__cond = threading.Condition()
+
+    def wait(self):
+        with self.__cond:
+            self.__waiting -= 1
+            if self.__waiting <= 0:
+                self.__cond.notify_all()
+            while self.__waiting > 0:
+                self.__cond.wait()
+
+
+# Insert exception without its traceback, so the frames are not kept alive.
+InsertError = collections.namedtuple('InsertError', ['type', 'message'])
 
 
 class InsertResult(object):
-    def __init__(self, source_file, exception=None):
-        self.__sf = source_file
-        self.__exception = exception
+    def __init__(self, fpath, error=None):
+        self.__fpath = fpath
+        self.__error = error
 
     @property
-    def source_file(self):
-        return self.__sf
+    def fpath(self):
+        return self.__fpath
 
     @property
-    def exception(self):
-        return self.__exception
+    def error(self):
+        """InsertError or None"""
+        return self.__error
 
     @property
     def has_error(self):
-        return self.__exception is not None
+        return self.__error is not None
+
+
+class InsertResultSink(object):
+    """Insert results with memory use independent of the number of files.
+
+    Counters of files inserted OK, with error and errors by type are updated
+    on every result. Only the first max_results results of each kind are kept
+    in memory. If spill_path is given, every result is also written to that
+    file, one JSON line per file, and results() reads them back from there.
+    Errors writing the spill file are logged, not raised: the counters are
+    always right.
+
+    Safe to use from several insert threads.
+
+    :param max_results: int. Optional. Results of each kind kept in memory.
+    :param spill_path: str. Optional. File where all the results are written.
+    """
+    def __init__(self, max_results=INSERT_RESULTS_SAMPLE, spill_path=None):
+        self.__max_results = max_results
+        self.__spill_path = spill_path
+        self.__spill = None
+        self.__lock = threading.Lock()
+        self.clear()
+
+    @property
+    def count_ok(self):
+        return self.__count_ok
+
+    @property
+    def count_error(self):
+        return self.__count_error
+
+    @property
+    def spill_path(self):
+        return self.__spill_path
+
+    def __len__(self):
+        return self.__count_ok + self.__count_error
+
+    def add(self, fpath, exception=None):
+        """Add the result of inserting fpath.
+
+        :param exception: Exception. Optional. Insert error, if any.
+        """
+        error = None
+        if exception is not None:
+            error = InsertError(type(exception).__name__,
+                                _exception_message(exception))
+
+        with self.__lock:
+            if error is None:
+                self.__count_ok += 1
+                sample = self.__sample_ok
+            else:
+                self.__count_error += 1
+                self.__error_types[error.type] += 1
+                sample = self.__sample_error
+            if len(sample) < self.__max_results:
+                sample.append(InsertResult(fpath, error))
+            if self.__spill_path is not None:
+                self.__spill_result(fpath, error)
+
+    def fail(self, fpath, exception):
+        """Change the result of a file added as inserted OK to an error.
+
+        Used for files which fail after the insert, when they are committed.
+        """
+        error = InsertError(type(exception).__name__,
+                            _exception_message(exception))
+
+        with self.__lock:
+            self.__count_ok -= 1
+            self.__count_error += 1
+            self.__error_types[error.type] += 1
+            for i, insert_res in enumerate(self.__sample_ok):
+                if insert_res.fpath == fpath:
+                    del self.__sample_ok[i]
+                    break
+            if len(self.__sample_error) < self.__max_results:
+                self.__sample_error.append(InsertResult(fpath, error))
+            if self.__spill_path is not None:
+                self.__spill_result(fpath, error, failed=True)
+
+    def __spill_result(self, fpath, error, failed=False):
+        import json
+        record = {'fpath': fpath}
+        if isinstance(fpath, str):
+            try:
+                fpath.decode('utf8')
+            except UnicodeDecodeError:
+                # JSON strings are unicode. Kept as escaped ASCII.
+                record = {'fpath_escaped': fpath.encode('string_escape')}
+        if error is not None:
+            record['error'] = error._asdict()
+        if failed:
+            # It replaces the OK result written before.
+            record['failed'] = True
+        try:
+            if self.__spill is None:
+                self.__spill = open(self.__spill_path, 'a')
+            self.__spill.write(json.dumps(record) + '\n')
+        except Exception:
+            logger_err.exception('Insert result spill exception',
+                                 extra={'fpath': fpath})
+
+    def errors_by_type(self):
+        """Counter of errors by exception class name."""
+        with self.__lock:
+            return collections.Counter(self.__error_types)
+
+    def results(self):
+        """Yield the InsertResult of every file, in insert order.
+
+        Without spill_path, only the results kept in memory: files inserted OK
+        first and then files with error.
+        """
+        import json
+        with self.__lock:
+            if self.__spill is not None:
+                self.__spill.flush()
+            if (self.__spill_path is not None and
+                    os.path.exists(self.__spill_path)):
+                sample = None
+            else:
+                sample = self.__sample_ok + self.__sample_error
+
+        if sample is not None:
+            for insert_res in sample:
+                yield insert_res
+            return
+
+        # Files whose OK result has been replaced by an error. See fail.
+        failed = set()
+        with open(self.__spill_path) as spill_file:
+            for line in spill_file:
+                if '"failed"' in line:
+                    failed.add(_spilled_fpath(json.loads(line)))
+
+        with open(self.__spill_path) as spill_file:
+            for line in spill_file:
+                record = json.loads(line)
+                fpath = _spilled_fpath(record)
+                error = record.get('error')
+                if error is not None:
+                    error = InsertError(error['type'].encode('utf8'),
+                                        error['message'])
+                elif fpath in failed:
+                    continue
+                yield InsertResult(fpath, error)
+
+    def clear(self):
+        """Remove all the results, also from the spill file."""
+        with self.__lock:
+            self.__close_spill()
+            if self.__spill_path is not None and os.path.exists(
+                    self.__spill_path):
+                os.remove(self.__spill_path)
+            self.__count_ok = 0
+            self.__count_error = 0
+            self.__error_types = collections.Counter()
+            self.__sample_ok = []
+            self.__sample_error = []
+
+    def close(self):
+        """Close the spill file. Results are kept."""
+        with self.__lock:
+            self.__close_spill()
+
+    def __close_spill(self):
+        if self.__spill is not None:
+            self.__spill.close()
+            self.__spill = None
+
+
+def _spilled_fpath(record):
+    """File path of an InsertResultSink spill record, as str."""
+    if 'fpath_escaped' in record:
+        return record['fpath_escaped'].encode('ascii').decode('string_escape')
+    # json loads strings as unicode. Paths are kept as str.
+    return record['fpath'].encode('utf8')
 
 
 class Repository(object):
@@ -189,12 +689,36 @@ class Repository(object):
         - Load repo settings from file (path, insert path policy, overwrite, etc.
         - Logging
     """
-    def __init__(self, path=None):
+    def __init__(self, path=None, staged=False, fsync_batch=FSYNC_BATCH_SIZE):
         # It can be None in case of new repository.
         self.__path = path
-        self.__sfm = SourceFilesManger(path)
+
+        # Staged commit of inserted files. See StagedCommit.
+        self.__staging = StagedCommit(fsync_batch) if staged else None
+        # Pages of copied files, dropped once written out. Staged files are
+        # dropped by StagedCommit.
+        self.__cache_drop = None if staged else DeferredCacheDrop(fsync_batch)
+
+        # Files in the repository. Loaded on first use, see __source_fm.
+        self.__sfm = None
         self.__hash_db = None
 
+        # Membership filter over the DB content. See ContentFilter.
+        self.__content_filter = None
+        # DB file pending to be loaded. See db_load(lazy=True).
+        self.__db_fpath = None
+
+        # Locks by file name. Concurrent inserts of files with the same name
+        # are serialized, so name collision checks and copies don't race.
+        self.__names_lock = threading.Lock()
+        self.__name_locks = collections.defaultdict(threading.Lock)
+
+        # Metadata catalog. See catalog_build and catalog_load.
+        self.__catalog = None
+
+        # Date index. See date_index.
+        self.__date_index = None
+
         if self.__path is not None:
             try:
                 _check_path(self.__path)
@@ -207,10 +731,20 @@ class Repository(object):
 
     @property
     def db(self):
+        if self.__hash_db is None and self.__db_fpath is not None:
+            self.__load_db(self.__db_fpath)
         if self.__hash_db is None:
             raise ValueError('DB not initialized.')
         return self.__hash_db
 
+    @property
+    def content_filter(self):
+        return self.__content_filter
+
+    def has_db(self):
+        """Check if the DB has been scanned or loaded (maybe lazily)."""
+        return self.__hash_db is not None or self.__db_fpath is not None
+
     def create(self, path):
         """Create a new repository.
 
@@ -228,11 +762,23 @@ class Repository(object):
         return self.__path is not None
 
     def insert(self, source_file, dest_path=None,
-               overwrite=False, alternate_names=False, dry_run=False):
+               overwrite=False, alternate_names=False, dry_run=False,
+               transfer=TRANSFER_COPY, check_content=True,
+               on_commit_error=None):
         """Create an importer object to insert the source file in the repository.
 
         It can be seen as a factory method which instantiate a concrete insert
         strategy.
+
+        transfer is TRANSFER_COPY, TRANSFER_LINK (hard link) or TRANSFER_MOVE.
+        If check_content is False, the content is not checked against the DB:
+        the caller already knows it's not there.
+
+        In staged mode the file is committed later, maybe by another insert.
+        If it can't be committed, on_commit_error is called with the exception.
+        See StagedCommit.
+
+        Return the destination file path.
         """
         if not self.is_valid():
             raise ValueError('Repository is not valid. Create a new one or '
@@ -271,12 +817,44 @@ class Repository(object):
         #     #traceback.print_exc(file=sys.stdout)
         #     raise ex
 
-        if self.__hash_db is not None:
+        if check_content and self.has_db():
             self.content_exist(source_file)
 
         repo_importer = importer_class(
-            source_file, dest_path_callback, dry_run)
-        repo_importer.insert()
+            source_file, dest_path_callback, dry_run, staging=self.__staging,
+            transfer=transfer, on_commit_error=on_commit_error,
+            cache_drop=self.__cache_drop,
+            on_commit=self.__insert_commit(source_file, transfer))
+        with self.__name_lock(source_file.basename):
+            dest_fpath = repo_importer.insert()
+        return dest_fpath
+
+    def __insert_commit(self, source_file, transfer):
+        """Return the callback of an inserted file once it's committed.
+
+        It adds the file to the catalog and invalidates its month in the date
+        index. Staged files are added when they are renamed into place.
+        """
+        def on_commit(dest_fpath):
+            if self.__catalog is not None:
+                if transfer == TRANSFER_MOVE:
+                    # The source file doesn't exist anymore.
+                    catalog_sf = source_file_factory(dest_fpath)
+                elif type(source_file) is SourceFile:
+                    # Generic SourceFile without dates, like in merge.
+                    catalog_sf = source_file_factory(source_file.fpath)
+                else:
+                    catalog_sf = source_file
+                self.__catalog.append(catalog_sf,
+                                      os.path.relpath(dest_fpath, self.__path),
+                                      sf_hash=source_file._hash)
+            if self.__date_index is not None:
+                self.__date_index.invalidate(os.path.dirname(dest_fpath))
+        return on_commit
+
+    def __name_lock(self, fname):
+        with self.__names_lock:
+            return self.__name_locks[fname.lower()]
 
     def __dest_path_factory(self, source_file, dest_path):
         if dest_path is None:
@@ -285,34 +863,89 @@ class Repository(object):
             return DestPathFixed(self, dest_path)
 
     def check(self):
-        self.__sfm.check()
+        self.__source_fm().check()
 
     def describe(self):
-        return self.__sfm.describe()
+        return self.__source_fm().describe()
 
     def describe_paths(self):
-        return self.__sfm.describe_paths()
+        return self.__source_fm().describe_paths()
 
     @property
     def files(self):
-        return self.__sfm.files
+        return self.__source_fm().files
+
+    def __source_fm(self):
+        """Return the SourceFilesManager of the whole repository.
 
-    def db_scan(self):
+        Loading it reads all the files in the repository, so it's not done
+        until it's needed. See date_index for date queries.
+        """
+        if self.__sfm is None:
+            self.__sfm = SourceFilesManger(self.__path,
+                                           exclude_ext=[STAGING_EXT])
+        return self.__sfm
+
+    def commit(self):
+        """Make staged files visible and durable. See StagedCommit.
+
+        Not in staged mode, it only drops the pages of the copied files from
+        the page cache.
+        """
+        if self.__staging is not None:
+            self.__staging.commit()
+        else:
+            self.__cache_drop.flush()
+
+    def remove_staged(self):
+        """Remove temporary files left by an interrupted staged import."""
+        for fpath in files_in_folder(self.__path):
+            if fpath.endswith('.' + STAGING_EXT):
+                os.remove(fpath)
+
+    @property
+    def date_index(self):
+        """RepositoryDateIndex over the YYYY/MM layout."""
+        if self.__date_index is None:
+            self.__date_index = RepositoryDateIndex(self)
+        return self.__date_index
+
+    def month_files(self, year, month):
+        """Return the files in the repository for the month, sorted by date."""
+        return self.date_index.month_files(year, month)
+
+    def files_between(self, start, end):
+        """Return the files with start <= date create < end, sorted by date."""
+        return self.date_index.between(start, end)
+
+    def db_scan(self, filter_capacity=None):
         """Scan through all directories in the repo to build the database.
 
+        The content filter is built at the same time. filter_capacity is the
+        number of files it is sized for, by default twice the repository files.
+
         Raise ValueError if it finds duplicate content.
         """
+        if filter_capacity is None:
+            filter_capacity = 2 * len(self.files)
         self.__hash_db = {}
-        for sf in self.__sfm.files:
+        self.__db_fpath = None
+        self.__content_filter = ContentFilter(filter_capacity)
+        for sf in self.files:
             sf_hash = sf.hash()
             if sf_hash in self.__hash_db:
                 f1 = sf.fpath
                 f2 = self.__hash_db[sf_hash]
                 raise ValueError('Duplicate file {} - {}'.format(f1, f2))
-            self.__hash_db[sf.hash()] = sf.fpath
+            self.__hash_db[sf_hash] = sf.fpath
+            self.__content_filter.add(sf, sf_hash)
 
     def db_save(self, path='./db/', fname='repo.pkl'):
-        """Save DB to file."""
+        """Save DB to file.
+
+        The content filter is saved next to it. See _filter_fname.
+        """
+        import pickle
         if self.__hash_db is None:
             raise ValueError('DB not initialized. Nothing to be saved.')
         fpath = os.path.join(path, fname)
@@ -320,13 +953,38 @@ class Repository(object):
             raise ValueError('Path does not exists.')
         with open(fpath, 'wb') as f:
             try:
-                pickle.dump(self.__hash_db, f)
+                pickle.dump(self.__hash_db, f, pickle.HIGHEST_PROTOCOL)
             except Exception:
                 print 'Error serializing DB.'
+        if self.__content_filter is not None:
+            with open(os.path.join(path, _filter_fname(fname)), 'wb') as f:
+                self.__content_filter.save(f)
+
+    def db_load(self,  path='./db/', fname='repo.pkl', lazy=False):
+        """Load DB from file.
 
-    def db_load(self,  path='./db/', fname='repo.pkl'):
-        """Load DB from file."""
+        The content filter is loaded if it has been saved. If lazy is True and
+        there's a content filter, the DB itself is loaded only the first time
+        the filter can't rule out a file being imported.
+        """
+        import pickle
         fpath = os.path.join(path, fname)
+        filter_fpath = os.path.join(path, _filter_fname(fname))
+
+        self.__hash_db = None
+        self.__db_fpath = None
+        self.__content_filter = None
+        if os.path.isfile(filter_fpath):
+            with open(filter_fpath, 'rb') as f:
+                self.__content_filter = ContentFilter.load(f)
+
+        if lazy and self.__content_filter is not None:
+            self.__db_fpath = fpath
+        else:
+            self.__load_db(fpath)
+
+    def __load_db(self, fpath):
+        import pickle
         with open(fpath, 'rb') as f:
             try:
                 self.__hash_db = pickle.load(f)
@@ -335,20 +993,280 @@ class Repository(object):
                 # nothing is printed. That's why we catch this concrete error, to
                 # print a personalized message.
                 print 'Error loading DB.'
+        self.__db_fpath = None
+
+    @property
+    def catalog(self):
+        if self.__catalog is None:
+            raise ValueError('Catalog not initialized.')
+        return self.__catalog
+
+    def catalog_build(self, exif=True):
+        """Build the metadata catalog from the repository files.
+
+        Hashes are taken from the DB if it has been initialized. Once built or
+        loaded, files inserted in the repository are appended to it.
+        """
+        hashes = None
+        if self.has_db():
+            hashes = dict((fpath, sf_hash)
+                          for sf_hash, fpath in self.db.iteritems())
+        self.__catalog = RepositoryCatalog.from_files(
+            self.files, self.__path, hashes=hashes, exif=exif)
+        return self.__catalog
+
+    def catalog_save(self, path='./db/', fname='catalog.npy'):
+        """Save the catalog to file."""
+        if os.path.exists(path) is False:
+            raise ValueError('Path does not exists.')
+        self.catalog.save(os.path.join(path, fname))
+
+    def catalog_load(self, path='./db/', fname='catalog.npy', mmap=True):
+        """Load the catalog from file. See RepositoryCatalog.load."""
+        self.__catalog = RepositoryCatalog.load(
+            os.path.join(path, fname), mmap=mmap)
+        return self.__catalog
+
+    def build_thumbnails(self, thumbnail_cache, purge=True):
+        """Build the thumbnails of all the files in the DB.
+
+        Thumbnails already in the cache are reused, even if the file has been
+        moved or renamed. If purge is True, thumbnails of content no longer in
+        the repository are removed from the cache.
+        """
+        for sf_hash, fpath in self.db.iteritems():
+            thumbnail_cache.submit(fpath, sf_hash)
+        thumbnail_cache.close()
+        if purge:
+            thumbnail_cache.purge(self.db)
+
+    def scrub(self, workers=4, max_bytes_per_sec=None, max_files_per_sec=None,
+              sample=None, checkpoint=None, io_order=IO_ORDER_PHYSICAL):
+        """Verify the repository files against the content hashes in the DB.
+
+        Files are hashed in parallel by workers threads. Reads can be limited
+        to max_bytes_per_sec and max_files_per_sec, so a scrub can run while
+        the repository is in use.
+
+        :param sample: int or float. Optional. Verify only a random sample of
+            the DB: a number of files or, if it's a float, a fraction.
+        :param checkpoint: str. Optional. File where results are appended as
+            they are produced. If it exists, the files already in it are not
+            verified again and its results are included: a stopped scrub
+            resumes where it was. The random seed of the sample is saved in
+            it, so a resumed scrub verifies the same sample.
+        :param io_order: str. Optional. Order files are read in. See
+            physical_order.
+        :return: ScrubReport
+        """
+        import json
+        import random
+
+        results = []
+        done = set()
+        sample_seed = None
+        if checkpoint is not None and os.path.isfile(checkpoint):
+            with open(checkpoint) as f:
+                for line in f:
+                    record = json.loads(line)
+                    if isinstance(record, dict):
+                        # Header of a sampled scrub.
+                        sample_seed = record['sample_seed']
+                        continue
+                    # json loads strings as unicode. Paths are kept as str.
+                    res = ScrubResult(*[
+                        v.encode('utf8') if isinstance(v, unicode) else v
+                        for v in record])
+                    results.append(res)
+                    done.add(res.fpath)
+
+        items = sorted(self.db.iteritems(), key=lambda item: item[1])
+        if sample is not None:
+            if isinstance(sample, float):
+                sample = int(round(len(items) * sample))
+            new_seed = sample_seed is None
+            if new_seed:
+                sample_seed = random.randrange(2 ** 32)
+            items = random.Random(sample_seed).sample(
+                items, min(sample, len(items)))
+            if checkpoint is not None and new_seed:
+                with open(checkpoint, 'a') as f:
+                    f.write(json.dumps({'sample_seed': sample_seed}) + '\n')
+        if io_order == IO_ORDER_PHYSICAL:
+            order = dict((fpath, i) for i, fpath in enumerate(
+                physical_order([fpath for _, fpath in items])))
+            items.sort(key=lambda item: order[item[1]])
+
+        tasks = Queue.Queue()
+        for sf_hash, fpath in items:
+            if fpath not in done:
+                tasks.put((sf_hash, fpath))
+
+        byte_limiter = RateLimiter(max_bytes_per_sec) \
+            if max_bytes_per_sec else None
+        file_limiter = RateLimiter(max_files_per_sec) \
+            if max_files_per_sec else None
+        lock = threading.Lock()
+        checkpoint_file = open(checkpoint, 'a') if checkpoint else None
+
+        def worker():
+            while True:
+                try:
+                    sf_hash, fpath = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                if file_limiter is not None:
+                    file_limiter.acquire(1)
+                try:
+                    actual = _md5_file(fpath, limiter=byte_limiter,
+                                       drop_cache=True)
+                except IOError:
+                    if os.path.exists(fpath):
+                        status = SCRUB_UNREADABLE
+                    else:
+                        status = SCRUB_MISSING
+                    res = ScrubResult(status, fpath, sf_hash, None)
+                except Exception:
+                    logger_err.exception('Scrub exception',
+                                         extra={'fpath': fpath})
+                    res = ScrubResult(SCRUB_ERROR, fpath, sf_hash, None)
+                else:
+                    status = SCRUB_OK if actual == sf_hash else SCRUB_CORRUPT
+                    res = ScrubResult(status, fpath, sf_hash, actual)
+                with lock:
+                    results.append(res)
+                    if checkpoint_file is not None:
+                        try:
+                            line = json.dumps(list(res))
+                        except ValueError:
+                            # Path not UTF-8. Verified again on resume.
+                            logger_err.exception('Scrub checkpoint exception',
+                                                 extra={'fpath': fpath})
+                        else:
+                            checkpoint_file.write(line + '\n')
+                            checkpoint_file.flush()
 
-    def content_exist(self, sf):
-        """Given a SourceFile check if exists in DB."""
-        sf_hash = sf.hash()
         try:
-            existing_fpath = self.__hash_db[sf_hash]
+            threads = [threading.Thread(target=worker)
+                       for _ in xrange(max(1, workers))]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            if checkpoint_file is not None:
+                checkpoint_file.close()
+
+        # Untracked files are found from the directory listing, without
+        # reading them. Staged files are not in the repository yet.
+        tracked = set(self.db.itervalues())
+        for fpath in files_in_folder(self.__path, exclude_ext=[STAGING_EXT]):
+            if fpath not in tracked:
+                results.append(ScrubResult(SCRUB_UNTRACKED, fpath, None, None))
+
+        return ScrubReport(results)
+
+    def merge(self, source_repo, transfer=TRANSFER_COPY, alternate_names=False,
+              dry_run=False):
+        """Insert the content of source_repo missing in this repository.
+
+        Both repositories DBs must be initialized. They are joined as sorted
+        streams of content hashes, so no file is hashed: only the files with
+        content missing here are read, to be copied (or linked, or moved).
+        Files keep their path relative to the source repository root, which
+        in a YYYY/MM layout is its capture month.
+
+        The DB, and content filter, of this repository are updated with the
+        inserted files. Files which can't be inserted, like files missing
+        from a stale source DB or not committed in a staged repository, are
+        reported in the errors.
+
+        :param alternate_names: bool. Optional. If a file with the same name
+            and different content exists, insert it with an alternate name
+            instead of reporting an error. See Repository.insert.
+        :return: MergeReport
+        """
+        source_db = source_repo.db
+        target_db = self.db
+        report = MergeReport()
+
+        for sf_hash, source_fpath, target_fpath in _merge_join(
+                sorted(source_db.iteritems()), sorted(target_db.iteritems())):
+            if source_fpath is None:
+                # Only in this repository.
+                continue
+            if target_fpath is not None:
+                report.duplicates.append((sf_hash, source_fpath, target_fpath))
+                continue
 
-            # No KeyError exception: hash exists.
-            raise ImporterDuplicateContentException(existing_fpath)
+            dest_path = os.path.dirname(
+                os.path.relpath(source_fpath, source_repo.path))
+            try:
+                # Generic SourceFile: the destination path is known, so the
+                # creation date isn't read.
+                sf = SourceFile(source_fpath)
+                sf._hash = sf_hash
+                signature = None
+                if not dry_run and self.__content_filter is not None:
+                    # Same content as the destination, which may be staged,
+                    # and the source may be moved.
+                    signature = ContentFilter.signature(sf)
+                dest_fpath = self.insert(
+                    sf, dest_path=dest_path, alternate_names=alternate_names,
+                    dry_run=dry_run, transfer=transfer, check_content=False,
+                    on_commit_error=self.__merge_commit_error(
+                        report, target_db, sf_hash, source_fpath))
+            except Exception, ex:
+                report.errors.append((source_fpath, _error_message(ex)))
+                continue
+
+            report.inserted.append((sf_hash, source_fpath, dest_fpath))
+            if not dry_run:
+                target_db[sf_hash] = dest_fpath
+                if self.__content_filter is not None:
+                    self.__content_filter.add(sf, sf_hash,
+                                              signature=signature)
+
+        self.commit()
+        return report
+
+    @staticmethod
+    def __merge_commit_error(report, target_db, sf_hash, source_fpath):
+        def commit_error(ex):
+            # The file was reported as inserted. The content filter may keep
+            # it: it only gives false positives.
+            target_db.pop(sf_hash, None)
+            report.inserted = [ins for ins in report.inserted
+                               if ins[0] != sf_hash]
+            report.errors.append((source_fpath, _error_message(ex)))
+        return commit_error
+
+    def content_exist(self, sf):
+        """Given a SourceFile check if exists in DB.
 
+        With a content filter, most new files are ruled out by its size and
+        partial hash, without reading the whole file nor loading the DB.
+        """
+        if self.__content_filter is not None:
+            if not self.__content_filter.may_contain(sf):
+                return False
+            sf_hash = sf.hash()
+            if not self.__content_filter.may_contain_hash(sf_hash):
+                return False
+        else:
+            sf_hash = sf.hash()
+        try:
+            existing_fpath = self.db[sf_hash]
         except KeyError:
             # Hash doesn't exist, so content doesn't exist in DB.
             return False
 
+        # The file is not copied: its pages, read for the hash, are not
+        # needed anymore.
+        _drop_cache(sf.fpath)
+        raise ImporterDuplicateContentException(existing_fpath)
+
     def __repr__(self):
         if self.__path is not None:
             return "Repository('{}')".format(self.__path)
@@ -356,21 +1274,492 @@ class Repository(object):
             return "Repository(None)"
 
 
+ScrubResult = collections.namedtuple(
+    'ScrubResult', ['status', 'fpath', 'expected', 'actual'])
+
+
+class ScrubReport(object):
+    """Results of Repository.scrub.
+
+    Each result is a ScrubResult(status, fpath, expected, actual) where status
+    is one of SCRUB_OK, SCRUB_CORRUPT (bit rot), SCRUB_MISSING,
+    SCRUB_UNREADABLE, SCRUB_UNTRACKED (file in the repository and not in the
+    DB) or SCRUB_ERROR (unexpected error verifying it).
+    """
+    def __init__(self, results):
+        self.__results = sorted(results, key=lambda res: res.fpath)
+
+    @property
+    def results(self):
+        return self.__results
+
+    def by_status(self, status):
+        return [res for res in self.__results if res.status == status]
+
+    def problems(self):
+        """Results which are not SCRUB_OK."""
+        return [res for res in self.__results if res.status != SCRUB_OK]
+
+    def counts(self):
+        return collections.Counter(res.status for res in self.__results)
+
+    def report(self):
+        counts = self.counts()
+        print 'Files verified OK: {}'.format(counts[SCRUB_OK])
+        print 'Files corrupt: {}'.format(counts[SCRUB_CORRUPT])
+        print 'Files missing: {}'.format(counts[SCRUB_MISSING])
+        print 'Files unreadable: {}'.format(counts[SCRUB_UNREADABLE])
+        print 'Files untracked: {}'.format(counts[SCRUB_UNTRACKED])
+        print 'Files with scrub ERR : {}'.format(counts[SCRUB_ERROR])
+
+
+class MergeReport(object):
+    """Results of Repository.merge.
+
+    inserted: [(hash, source fpath, dest fpath)]
+    duplicates: [(hash, source fpath, target fpath)] Content in both.
+    errors: [(source fpath, error message)]
+    """
+    def __init__(self):
+        self.inserted = []
+        self.duplicates = []
+        self.errors = []
+
+    def report(self):
+        print 'Files inserted: {}'.format(len(self.inserted))
+        print 'Duplicate files: {}'.format(len(self.duplicates))
+        print 'Files with insert ERR : {}'.format(len(self.errors))
+
+
+class RateLimiter(object):
+    """Token bucket rate limiter shared by threads.
+
+    acquire(amount) blocks as needed to keep the average rate under rate
+    units per second, allowing bursts up to burst units.
+    """
+    def __init__(self, rate, burst=None):
+        self.__rate = float(rate)
+        self.__burst = float(burst if burst is not None else rate)
+        self.__tokens = self.__burst
+        self.__last = time.time()
+        self.__lock = threading.Lock()
+
+    def acquire(self, amount):
+        with self.__lock:
+            now = time.time()
+            self.__tokens = min(
+                self.__burst,
+                self.__tokens + (now - self.__last) * self.__rate)
+            self.__last = now
+            # Tokens may go negative: the caller waits to pay the debt.
+            self.__tokens -= amount
+            wait = -self.__tokens / self.__rate if self.__tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class RepositoryDateIndex(object):
+    """Date index over the YYYY/MM repository layout. See DestPathYearMonth.
+
+    Month directories are listed from the layout without reading any file.
+    The files of a month are loaded the first time the month is queried and
+    kept sorted by date, so range queries only load the months in the range
+    and locate the files with a binary search.
+
+    :param repository: Repository
+    :param date_from_name: DateFromName. Optional. See SourceFilesManger.
+    """
+    def __init__(self, repository, date_from_name=None):
+        self.__repo = repository
+        self.__date_from_name = date_from_name
+
+        # Sorted [(year, month)] with a directory in the repository.
+        self.__months = None
+
+        # {(year, month): (sorted dates, files sorted by date, undated files)}
+        self.__index = {}
+
+    def months(self):
+        """Return the sorted list of (year, month) in the repository."""
+        if self.__months is None:
+            months = []
+            root = self.__repo.path
+            for year in os.listdir(root):
+                if not (len(year) == 4 and year.isdigit()):
+                    continue
+                year_path = os.path.join(root, year)
+                if not os.path.isdir(year_path):
+                    continue
+                for month in os.listdir(year_path):
+                    if (len(month) == 2 and month.isdigit() and
+                            os.path.isdir(os.path.join(year_path, month))):
+                        months.append((int(year), int(month)))
+            self.__months = sorted(months)
+        return self.__months
+
+    def month_path(self, year, month):
+        return os.path.join(self.__repo.path, '{:04d}'.format(year),
+                            '{:02d}'.format(month))
+
+    def __month_index(self, year, month):
+        key = (year, month)
+        if key not in self.__index:
+            if key not in self.months():
+                self.__index[key] = ([], [], [])
+                return self.__index[key]
+            sfm = SourceFilesManger(
+                self.month_path(year, month), recursive=False,
+                exclude_ext=[STAGING_EXT], date_from_name=self.__date_from_name)
+            dated = []
+            undated = []
+            for sf in sfm.files:
+                if sf.has_date_error:
+                    undated.append(sf)
+                else:
+                    dated.append((sf.date_create(), sf.fpath, sf))
+            dated.sort()
+            self.__index[key] = ([date for date, _, _ in dated],
+                                 [sf for _, _, sf in dated],
+                                 undated)
+        return self.__index[key]
+
+    def month_files(self, year, month):
+        """Return the files of the month sorted by date.
+
+        Files without a valid date are at the end.
+        """
+        _, files, undated = self.__month_index(year, month)
+        return files + undated
+
+    def between(self, start, end):
+        """Return the files with start <= date create < end, sorted by date."""
+        files = []
+        for year, month in self.months():
+            month_start = datetime(year, month, 1)
+            if month == 12:
+                month_end = datetime(year + 1, 1, 1)
+            else:
+                month_end = datetime(year, month + 1, 1)
+            if month_end <= start or month_start >= end:
+                continue
+            dates, month_files, _ = self.__month_index(year, month)
+            lo = bisect.bisect_left(dates, start)
+            hi = bisect.bisect_left(dates, end)
+            files.extend(month_files[lo:hi])
+        return files
+
+    def invalidate(self, path=None):
+        """Discard the index for the month directory path, or all if None."""
+        if path is None:
+            self.__months = None
+            self.__index = {}
+            return
+        rel = os.path.relpath(path, self.__repo.path).split(os.sep)
+        try:
+            key = (int(rel[0]), int(rel[1]))
+        except (IndexError, ValueError):
+            return
+        self.__index.pop(key, None)
+        if self.__months is not None and key not in self.__months:
+            self.__months = None
+
+
+class BloomFilter(object):
+    """Bloom filter over strings.
+
+    A membership test can give false positives, at most at error_rate when
+    capacity items have been added, but never false negatives.
+
+    :param capacity: int. Expected number of items.
+    :param error_rate: float. False positive rate at capacity.
+    """
+    def __init__(self, capacity, error_rate=CONTENT_FILTER_ERROR_RATE):
+        capacity = max(capacity, 1)
+        nbits = int(math.ceil(
+            -capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.__nbits = max(nbits, 8)
+        self.__nhashes = max(
+            1, int(round(float(self.__nbits) / capacity * math.log(2))))
+        self.__bits = bytearray((self.__nbits + 7) // 8)
+
+    def __indexes(self, key):
+        import hashlib
+        # Double hashing: k indexes from the two halves of a single MD5.
+        h1, h2 = struct.unpack('<QQ', hashlib.md5(key).digest())
+        for i in xrange(self.__nhashes):
+            yield (h1 + i * h2) % self.__nbits
+
+    def add(self, key):
+        for idx in self.__indexes(key):
+            self.__bits[idx >> 3] |= 1 << (idx & 7)
+
+    def __contains__(self, key):
+        bits = self.__bits
+        for idx in self.__indexes(key):
+            if not bits[idx >> 3] & (1 << (idx & 7)):
+                return False
+        return True
+
+    def __len__(self):
+        """Filter size in bytes."""
+        return len(self.__bits)
+
+    def dump(self):
+        """Return the filter as plain data: (nbits, nhashes, bits)."""
+        return self.__nbits, self.__nhashes, str(self.__bits)
+
+    @classmethod
+    def load(cls, data):
+        """Build a filter from the data returned by dump."""
+        bloom = cls.__new__(cls)
+        bloom.__nbits, bloom.__nhashes, bits = data
+        bloom.__bits = bytearray(bits)
+        return bloom
+
+
+class ContentFilter(object):
+    """Membership filter over the repository content.
+
+    It holds two Bloom filters: one over content hashes and one over the
+    (size, partial hash) of each file. A file whose size and partial hash are
+    not in the filter is new, and it's not necessary to read it completely.
+    Only possible hits have to be checked against the full DB.
+
+    :param capacity: int. Expected number of files in the repository.
+    """
+    def __init__(self, capacity, error_rate=CONTENT_FILTER_ERROR_RATE):
+        self.__hashes = BloomFilter(capacity, error_rate)
+        self.__signatures = BloomFilter(capacity, error_rate)
+
+    @staticmethod
+    def signature(sf):
+        return '{}:{}'.format(sf.size, sf.partial_hash())
+
+    def add(self, sf, sf_hash=None, signature=None):
+        """Add the file content.
+
+        signature can be given if it has been computed before, for instance
+        from a file with the same content which is not readable anymore.
+        """
+        if sf_hash is None:
+            sf_hash = sf.hash()
+        if signature is None:
+            signature = self.signature(sf)
+        self.__hashes.add(sf_hash)
+        self.__signatures.add(signature)
+
+    def may_contain(self, sf):
+        """False if the file content is for sure not in the repository."""
+        return self.signature(sf) in self.__signatures
+
+    def may_contain_hash(self, sf_hash):
+        """False if the content hash is for sure not in the repository."""
+        return sf_hash in self.__hashes
+
+    def save(self, f):
+        """Save the filter to the open file.
+
+        The bits and parameters of the Bloom filters are pickled as plain
+        data, not the object: its class may be __main__.ContentFilter when
+        run from the command line.
+        """
+        import pickle
+        data = {'hashes': self.__hashes.dump(),
+                'signatures': self.__signatures.dump()}
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, f):
+        """Load a filter saved with save from the open file."""
+        import pickle
+        data = pickle.load(f)
+        content_filter = cls.__new__(cls)
+        content_filter.__hashes = BloomFilter.load(data['hashes'])
+        content_filter.__signatures = BloomFilter.load(data['signatures'])
+        return content_filter
+
+
+class RepositoryCatalog(object):
+    """Columnar metadata catalog of the repository files.
+
+    One row per file in a NumPy structured array with the fields:
+
+        path    Path relative to the repository root.
+        size    File size in bytes.
+        hash    MD5 content hash.
+        date    Capture date, datetime64[s]. NaT if unknown.
+        type    File type. See sniff_file_type.
+        make, model, iso, width, height
+                EXIF fields. Empty or 0 if unknown.
+
+    It's saved as a .npy file, which can be loaded memory mapped. Queries are
+    vectorized scans over the columns and don't read any image file:
+
+        catalog.select(start=datetime(2015, 7, 1), end=datetime(2015, 8, 1))
+        catalog.count_by_month(types=['jpeg'])
+
+    Requires NumPy.
+    """
+    def __init__(self, array=None):
+        np = _numpy()
+        if array is None:
+            array = np.zeros(0, dtype=_catalog_dtype(1))
+        self.__array = array
+        # Rows appended and not yet merged into the array.
+        self.__pending = []
+
+    @classmethod
+    def from_files(cls, source_files, root, hashes=None, exif=True):
+        """Build a catalog from SourceFiles under the root path.
+
+        hashes is an optional {fpath: hash} dict, to not hash the files again.
+        """
+        catalog = cls()
+        for sf in source_files:
+            sf_hash = hashes.get(sf.fpath) if hashes is not None else None
+            catalog.append(sf, os.path.relpath(sf.fpath, root),
+                           sf_hash=sf_hash, exif=exif)
+        return catalog
+
+    @classmethod
+    def load(cls, fpath, mmap=True):
+        """Load a catalog saved with save. mmap maps the file read only."""
+        np = _numpy()
+        return cls(np.load(fpath, mmap_mode='r' if mmap else None))
+
+    def save(self, fpath):
+        _numpy().save(fpath, self.array)
+
+    def append(self, sf, relpath, sf_hash=None, exif=True):
+        """Add the row of the SourceFile, stored at relpath in the repository."""
+        if sf_hash is None:
+            sf_hash = sf.hash()
+        try:
+            date = sf.date_create()
+        except Exception:
+            date = None
+
+        exif_values = dict((field, None) for field, _ in CATALOG_EXIF_FIELDS)
+        if exif and isinstance(sf, SourceFileEXIF):
+            try:
+                exif_data = sf.exif_data
+            except PhotoException:
+                exif_data = {}
+            for field, tag in CATALOG_EXIF_FIELDS:
+                exif_values[field] = exif_data.get(tag)
+
+        self.__pending.append((
+            relpath, sf.size, sf_hash,
+            date if date is not None else 'NaT',
+            sf.file_type or '',
+            _exif_str(exif_values['make']),
+            _exif_str(exif_values['model']),
+            _exif_int(exif_values['iso']),
+            _exif_int(exif_values['width']),
+            _exif_int(exif_values['height']),
+        ))
+
+    @property
+    def array(self):
+        """Catalog structured array."""
+        if self.__pending:
+            np = _numpy()
+            path_len = max(self.__array.dtype['path'].itemsize,
+                           max(len(row[0]) for row in self.__pending))
+            dtype = _catalog_dtype(path_len)
+            pending = np.array(self.__pending, dtype=dtype)
+            self.__array = np.concatenate(
+                [self.__array.astype(dtype), pending])
+            self.__pending = []
+        return self.__array
+
+    def __len__(self):
+        return len(self.__array) + len(self.__pending)
+
+    def mask(self, start=None, end=None, types=None):
+        """Boolean mask of the rows with start <= date < end and type in types.
+
+        Rows without date are excluded when start or end are given.
+        """
+        np = _numpy()
+        array = self.array
+        mask = np.ones(len(array), dtype=bool)
+        if start is not None:
+            mask &= array['date'] >= np.datetime64(start, 's')
+        if end is not None:
+            mask &= array['date'] < np.datetime64(end, 's')
+        if types is not None:
+            mask &= np.in1d(array['type'], list(types))
+        return mask
+
+    def select(self, start=None, end=None, types=None):
+        """Return the rows matching the filters. See mask."""
+        return self.array[self.mask(start, end, types)]
+
+    def count_by_month(self, start=None, end=None, types=None):
+        """Return [('YYYY-MM', count)] for the rows matching the filters."""
+        np = _numpy()
+        dates = self.select(start, end, types)['date']
+        dates = dates[~np.isnat(dates)] if hasattr(np, 'isnat') else \
+            dates[dates == dates]
+        months, counts = np.unique(dates.astype('M8[M]'), return_counts=True)
+        return [(str(month), int(count)) for month, count in zip(months, counts)]
+
+    def count_by_type(self, start=None, end=None, types=None):
+        """Return [(type, count)] for the rows matching the filters."""
+        np = _numpy()
+        file_types, counts = np.unique(self.select(start, end, types)['type'],
+                                       return_counts=True)
+        return [(str(t), int(c)) for t, c in zip(file_types, counts)]
+
+    def total_size(self, start=None, end=None, types=None):
+        """Total size in bytes of the rows matching the filters."""
+        return int(self.select(start, end, types)['size'].sum())
+
+
 class SourceFilesManger(object):
     """Manages a set of SourceFiles.
 
+    The SourceFile class used for each file is chosen from the file type
+    detected from its first bytes (see sniff_file_type), not from its extension.
+    The factory parameter overrides the registered handlers per file type:
+
     factory = {
-        'jpg': (SourceFileDateFromName,
+        'jpeg': SourceFileDateFromName,
     }
+
+    Files whose type has no handler are loaded as generic SourceFile, which
+    reports a date error, or skipped when skip_unsupported is True.
+
+    date_from_name is an optional DateFromName. When given, dates are extracted
+    from all file names in one batch before any file is opened, and the files
+    of a known type (see sniff_file_type) with a date in its name are loaded as
+    SourceFileDateFromName.
+
+    io_order sets the order of the files, which is the order they are read in
+    when loading, hashing and copying: IO_ORDER_WALK (os.walk order) or
+    IO_ORDER_PHYSICAL (disk layout order, see physical_order).
+
+    Statistics of the files (see SourceStats) are collected while loading and
+    kept up to date by add_file and remove_file. describe, describe_paths,
+    check and files_with_date_error read them instead of going over all the
+    files.
     """
     def __init__(self, path, recursive=True, to_lower=False, regexp=None,
-                 exclude_ext=None, factory=None):
+                 exclude_ext=None, factory=None, skip_unsupported=False,
+                 date_from_name=None, io_order=IO_ORDER_WALK):
         self.__path = path
         self.__recursive = recursive
         self.__to_lower = to_lower
         self.__regexp = regexp
         self.__exclude_ext = exclude_ext
         self.__factory = factory
+        self.__skip_unsupported = skip_unsupported
+        self.__date_from_name = date_from_name
+        self.__io_order = io_order
+
+        # Paths of files skipped because its type has no handler.
+        self.__unsupported = []
 
         # Path to all files in the source.
         self.__spaths = None
@@ -378,6 +1767,9 @@ class SourceFilesManger(object):
         # Concrete SourceFiles objects for all files in the source.
         self.__sfiles = None
 
+        # Statistics of __sfiles.
+        self.__stats = SourceStats()
+
         # Check the given path is ok.
         try:
             _check_path(self.__path)
@@ -387,85 +1779,241 @@ class SourceFilesManger(object):
         # Load Source Files
         self.__load()
 
+    @property
+    def path(self):
+        return self.__path
+
     @property
     def files(self):
         return self.__sfiles
 
+    @property
+    def stats(self):
+        """SourceStats of the files."""
+        return self.__stats
+
     def files_with_date_error(self):
-        # self.__load()
-        # TODO return generator
-        return [sf for sf in self.__sfiles
-                if sf.has_date_error]
-
-    def __factory_method(self, sf):
-        if sf.extension.lower() in ['jpg']:
-            return SourceFileEXIF(sf.fpath)
-        elif sf.extension.lower() in ['mov', 'mp4']:
-            return SourceFileMPEG4(sf.fpath)
-        else:
-            # Generic SourceFile
-            return sf
+        return self.__stats.date_errors()
+
+    def unsupported_paths(self):
+        """Return the paths skipped because its file type has no handler."""
+        return self.__unsupported
+
+    def __factory_method(self, spath, file_type):
+        # Only the file header is read here. Unsupported files are discarded
+        # before any date extraction is done.
+        if (self.__skip_unsupported and
+                file_type_handler(file_type, self.__factory) is None):
+            self.__unsupported.append(spath)
+            return None
+        return source_file_factory(spath, self.__factory, file_type=file_type)
+
+    def __source_file(self, spath, dates):
+        file_type = sniff_file_type(spath)
+        # The date in the name is used for photos and videos only, not for
+        # any file with a date in its name.
+        if spath in dates and file_type is not None:
+            return SourceFileDateFromName(
+                spath, date_from_name=self.__date_from_name,
+                date_create=dates[spath], file_type=file_type)
+        return self.__factory_method(spath, file_type)
 
     def __load(self):
         if self.__sfiles is None:
             # TODO implementar generador
             # http://stackoverflow.com/questions/19151/build-a-basic-python-iterator
-            self.__sfiles = [self.__factory_method(SourceFile(sp))
-                             for sp in self.source_paths()]
+            spaths = self.source_paths()
+            if self.__date_from_name is not None:
+                dates = self.__date_from_name.parse_paths(spaths)
+            else:
+                dates = {}
+            self.__sfiles = []
+            self.__stats.clear()
+            for spath in spaths:
+                sf = self.__source_file(spath, dates)
+                if sf is not None:
+                    self.__sfiles.append(sf)
+                    self.__stats.add(sf)
+
+    def add_file(self, source_file):
+        """Add a file to the source and update the statistics.
+
+        :param source_file: SourceFile or str. A path is loaded like the files
+            found when scanning. Unsupported files are skipped when
+            skip_unsupported is True.
+        :return: SourceFile added, or None if it has been skipped.
+        """
+        if isinstance(source_file, basestring):
+            dates = {}
+            if self.__date_from_name is not None:
+                dates = self.__date_from_name.parse_paths([source_file])
+            source_file = self.__source_file(source_file, dates)
+            if source_file is None:
+                return None
+        if source_file.fpath in self.__stats:
+            raise ValueError(
+                'File already in the source: {}'.format(source_file.fpath))
+        self.__sfiles.append(source_file)
+        self.__spaths.append(source_file.fpath)
+        self.__stats.add(source_file)
+        return source_file
+
+    def remove_file(self, fpath):
+        """Remove the file with the given path and update the statistics.
+
+        :return: SourceFile removed.
+        """
+        if fpath not in self.__stats:
+            raise ValueError('File not in the source: {}'.format(fpath))
+        for i, sf in enumerate(self.__sfiles):
+            if sf.fpath == fpath:
+                del self.__sfiles[i]
+                break
+        self.__spaths.remove(fpath)
+        self.__stats.remove(sf)
+        return sf
 
     def __read_source_paths(self):
         """Read and return the path for all files in the SourceFileManager path."""
         self.__spaths = files_in_folder(
             self.__path, recursive=self.__recursive, to_lower=self.__to_lower,
             regexp=self.__regexp, exclude_ext=self.__exclude_ext)
+        if self.__io_order == IO_ORDER_PHYSICAL:
+            self.__spaths = physical_order(self.__spaths)
         return self.__spaths
 
     def source_paths(self):
         """Return the path for all files in the SourceFileManager path."""
         if self.__spaths is None:
             self.__read_source_paths()
-            self.__read_source_paths()
         return self.__spaths
 
     def describe(self):
-        """Print type and number of files in the source."""
-        # self.__load()
-        extensions = [f.extension for f in self.__sfiles]
-        counter = collections.Counter(extensions)
-        return list(counter.iteritems())
+        """Return the list of (extension, number of files)."""
+        return self.__stats.describe()
 
     def describe_paths(self):
-        return sorted(list(collections.Counter(
-            [sf.path for sf in self.files]).iteritems()))
+        """Return the sorted list of (directory, number of files)."""
+        return self.__stats.describe_paths()
 
-    def check(self):
-        total_proc= 0
-        total_err = 0
-        total = len(self.__sfiles)
+    def describe_dates(self):
+        """Return the sorted list of ((year, month), number of files)."""
+        return self.__stats.describe_dates()
 
-        for sf in self.__sfiles:
-            total_proc += 1
-            if sf.has_date_error:
-                total_err += 1
-                print sf.date_error_message
+    def check(self):
+        for sf in self.__stats.date_errors():
+            print sf.date_error_message
 
-        print 'Total files: {}'.format(total)
-        print 'Total processed files: {}'.format(total_proc)
-        print 'Error files: {}'.format(total_err)
+        print 'Total files: {}'.format(len(self.__stats))
+        print 'Total processed files: {}'.format(len(self.__stats))
+        print 'Error files: {}'.format(self.__stats.count_date_error)
+        print 'Total size: {}'.format(self.__stats.size)
 
     def __len__(self):
-        # self.__load()
         return len(self.__sfiles)
 
     def __repr__(self):
         return "SourceFilesManger('{}')".format(self.__path)
 
 
+class SourceStats(object):
+    """Statistics of a set of SourceFiles, updated file by file.
+
+    Number of files by extension and by directory, sizes, files with date
+    error and number of files by (year, month) of its create date. Each file
+    is visited once, when added, so reading them doesn't go over the files.
+    """
+    def __init__(self, source_files=None):
+        self.clear()
+        for sf in source_files or []:
+            self.add(sf)
+
+    def clear(self):
+        # {fpath: size}. Size when the file was added, to remove the same.
+        self.__sizes = {}
+        self.__size = 0
+        self.__extensions = collections.Counter()
+        self.__extension_sizes = collections.Counter()
+        self.__paths = collections.Counter()
+        self.__months = collections.Counter()
+        # Files with date error, in the order they were added.
+        self.__date_errors = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.__sizes)
+
+    def __contains__(self, fpath):
+        return fpath in self.__sizes
+
+    @property
+    def size(self):
+        """Total size in bytes."""
+        return self.__size
+
+    @property
+    def count_date_error(self):
+        return len(self.__date_errors)
+
+    def add(self, sf):
+        size = sf.size
+        self.__sizes[sf.fpath] = size
+        self.__size += size
+        self.__extensions[sf.extension] += 1
+        self.__extension_sizes[sf.extension] += size
+        self.__paths[sf.path] += 1
+        if sf.has_date_error:
+            self.__date_errors[sf.fpath] = sf
+        else:
+            date = sf.date_create()
+            self.__months[(date.year, date.month)] += 1
+
+    def remove(self, sf):
+        size = self.__sizes.pop(sf.fpath)
+        self.__size -= size
+        _counter_sub(self.__extensions, sf.extension, 1)
+        self.__extension_sizes[sf.extension] -= size
+        if sf.extension not in self.__extensions:
+            del self.__extension_sizes[sf.extension]
+        _counter_sub(self.__paths, sf.path, 1)
+        if sf.has_date_error:
+            del self.__date_errors[sf.fpath]
+        else:
+            date = sf.date_create()
+            _counter_sub(self.__months, (date.year, date.month), 1)
+
+    def describe(self):
+        """Return the list of (extension, number of files)."""
+        return list(self.__extensions.iteritems())
+
+    def describe_sizes(self):
+        """Return the list of (extension, size in bytes)."""
+        return list(self.__extension_sizes.iteritems())
+
+    def describe_paths(self):
+        """Return the sorted list of (directory, number of files)."""
+        return sorted(self.__paths.iteritems())
+
+    def describe_dates(self):
+        """Return the sorted list of ((year, month), number of files)."""
+        return sorted(self.__months.iteritems())
+
+    def date_errors(self):
+        """Return the SourceFiles with date error."""
+        return self.__date_errors.values()
+
+
 class SourceFile(object):
     """File to be included in the repository."""
-    def __init__(self, fpath):
+    def __init__(self, fpath, file_type=None):
         self._fpath = fpath
         self._date_create = None
+        # File type detected from the header. Sniffed on demand if not given.
+        self._file_type = file_type
+        # Content hash, computed once. See hash().
+        self._hash = None
+        # Directory and extension, split from fpath once.
+        self._path = None
+        self._extension = None
         # self.__has_import_error = False
         self.__has_date_error = False
         self.__date_error_message = None
@@ -487,7 +2035,9 @@ class SourceFile(object):
     @property
     def path(self):
         """Return the file path without filename."""
-        return os.path.dirname(self._fpath)
+        if self._path is None:
+            self._path = os.path.dirname(self._fpath)
+        return self._path
 
     @property
     def basename(self):
@@ -505,15 +2055,41 @@ class SourceFile(object):
     @property
     def extension(self):
         """File extension."""
-        return os.path.splitext(self._fpath)[1][1:]
+        if self._extension is None:
+            self._extension = os.path.splitext(self._fpath)[1][1:]
+        return self._extension
+
+    @property
+    def file_type(self):
+        """File type detected from the file header, e.g. 'jpeg', 'mov'.
+
+        None if the file type is unknown.
+        """
+        if self._file_type is None:
+            self._file_type = sniff_file_type(self._fpath)
+        return self._file_type
+
+    @property
+    def size(self):
+        """File size in bytes."""
+        return os.path.getsize(self._fpath)
 
     def hash(self):
-        """Compute a MD5 hash."""
+        """Compute a MD5 hash.
+
+        The hash is computed once and kept for the life of the object.
+        """
+        if self._hash is not None:
+            return self._hash
+        # Pages are kept in cache: the file is usually copied next.
+        self._hash = _md5_file(self._fpath)
+        return self._hash
+
+    def partial_hash(self, size=PARTIAL_HASH_SIZE):
+        """Compute a MD5 hash of the first size bytes of the file."""
+        import hashlib
         with open(self._fpath, 'rb') as f:
-            hasher = hashlib.md5()
-            hasher.update(f.read())
-            hsh = hasher.hexdigest()
-            return hsh
+            return hashlib.md5(f.read(size)).hexdigest()
 
     def date_create(self):
         raise NotImplementedError("Subclasses must implement 'date_create' method.")
@@ -536,13 +2112,14 @@ class SourceFile(object):
         except NotImplementedError:
             self.__date_error_message = (
                 "{} Unexpected file type '{}'. You can exclude the "
-                "extension.".format(self.fpath, self.extension))
+                "extension.".format(self.fpath, self._file_type or self.extension))
         except PhotoException, ex:
             self.__date_error_message = ex.message
         except Exception, ex:
             self.__date_error_message = (
                 "{} {} Unexpected "
-                "error: {}.".format(self.fpath, self.__name__, ex.message))
+                "error: {}.".format(self.fpath, self.__class__.__name__,
+                                    ex.message))
 
     def __repr__(self):
         return "{0}('{1}')".format(self.__class__.__name__, self._fpath)
@@ -555,6 +2132,7 @@ class SourceFileEXIF(SourceFile):
         self.__img = None
 
     def __load(self):
+        from PIL import Image
         try:
             self.__img = Image.open(self._fpath)
             # self.__img = Image.open(open(self._fpath, 'rb'))
@@ -592,13 +2170,15 @@ class SourceFileEXIF(SourceFile):
             raise PhotoException('{} SourceFileEXIF EXIF data does not have '
                            'creation date.'.format(self._fpath))
         try:
-            return datetime.strptime(create, '%Y:%m:%d %H:%M:%S')
+            self._date_create = datetime.strptime(create, '%Y:%m:%d %H:%M:%S')
+            return self._date_create
         except ValueError, ex:
             raise PhotoException('{} SourceFileEXIF invalid EXIF '
                                  'data: {}.'.format(self._fpath, ex.message))
 
     @property
     def exif_data(self, tags=True):
+        from PIL import ExifTags
         self.__load()
         exif_data = self.__exif_data()
         if tags:
@@ -679,44 +2259,180 @@ class SourceFileDateFromName(SourceFile):
     Example:
         2016-08-23 14.23.15.jpg
         This is the case for Dropbox Camera Upload files.
+
+    The date is parsed with a DateFromName built from regex and format, or with
+    the given date_from_name. date_create can be given when it has already been
+    extracted, as SourceFilesManger does with DateFromName.parse_paths.
     """
-    def __init__(self, fpath, regex=None, format=None):
-        super(SourceFileDateFromName, self).__init__(fpath)
-        self.__regex = regex
-        self.__format = format
+    def __init__(self, fpath, regex=None, format=None, file_type=None,
+                 date_from_name=None, date_create=None):
+        # Set before calling the parent constructor, which checks date_create.
+        if date_from_name is None:
+            if regex is None and format is None:
+                date_from_name = DEFAULT_DATE_FROM_NAME
+            else:
+                date_from_name = DateFromName(
+                    [('custom', regex, format or DROPBOX_DATE_FORMAT)])
+        self.__date_from_name = date_from_name
+        self.__date = date_create
+        super(SourceFileDateFromName, self).__init__(fpath, file_type=file_type)
 
     def date_create(self):
-        if self.__regex is None:
-            # Dropbox Camera Upload format
-            match = re.search('\d{4}-\d{2}-\d{2}\s\d{2}\.\d{2}\.\d{2}', self.name)
-            if match:
-                date_string = match.group()
-        else:
-            match = re.search(self.__regex, self.name)
-            if match:
-                date_string = match.group()
+        if self.__date is None:
+            self.__date = self.__date_from_name.parse(self.name)
+            if self.__date is None:
+                raise PhotoException("{} SourceFileDateFromName: Can't extract "
+                                     "date from file name.".format(self._fpath))
+        return self.__date
+
+
+# Dropbox Camera Upload file names: 2016-08-23 14.23.15.jpg
+DROPBOX_DATE_FORMAT = '%Y-%m-%d %H.%M.%S'
+
+# Directives supported by the fixed layout parser and its width.
+_FIXED_LAYOUT_DIRECTIVES = collections.OrderedDict([
+    ('%Y', 4), ('%m', 2), ('%d', 2), ('%H', 2), ('%M', 2), ('%S', 2),
+])
+
+
+class DateFromName(object):
+    """Extract creation dates from file names.
+
+    patterns is a list of (name, regex, format) tried in order. regex locates
+    the date in the file name (without extension) and format parses the
+    matched text. If regex is None it is built from format.
+
+    Patterns are compiled once. Formats made only of %Y %m %d %H %M %S and
+    literal characters are parsed by slicing the matched text at fixed
+    positions instead of calling datetime.strptime, when the matched text has
+    the width of the format. A custom regex may match dates without leading
+    zeros, like '2016-8-23', which are parsed with strptime.
+
+        dfn = DateFromName([('dropbox', None, '%Y-%m-%d %H.%M.%S')])
+        dfn.parse('2016-08-23 14.23.15')
+        dfn.parse_paths(files_in_folder('/home/sergi/Dropbox/Camera Uploads'))
+    """
+    def __init__(self, patterns=None):
+        if patterns is None:
+            patterns = [('dropbox', None, DROPBOX_DATE_FORMAT)]
+        self.__patterns = [self.__compile(name, regex, fmt)
+                           for name, regex, fmt in patterns]
+
+    @staticmethod
+    def __compile(name, regex, fmt):
+        """Return (name, compiled regex, format, fixed layout slices, width)."""
+        layout = _fixed_layout(fmt)
+        if regex is None:
+            if layout is None:
+                raise ValueError(
+                    "A regex is required for the date format '{}'.".format(fmt))
+            regex = layout[0]
+        if layout is None:
+            return name, re.compile(regex), fmt, None, None
+        return name, re.compile(regex), fmt, layout[1], layout[2]
+
+    def match(self, name):
+        """Return (pattern name, datetime) for the first matching pattern.
+
+        Return None if no pattern matches the name.
+        """
+        for pattern_name, regex, fmt, slices, width in self.__patterns:
+            match = regex.search(name)
+            if not match:
+                continue
+            date_string = match.group()
+            try:
+                if slices is not None and len(date_string) == width:
+                    date = datetime(*[int(date_string[i:j]) if i is not None
+                                      else default
+                                      for i, j, default in slices])
+                else:
+                    date = datetime.strptime(date_string, fmt)
+            except ValueError:
+                continue
+            return pattern_name, date
+        return None
+
+    def parse(self, name):
+        """Return the datetime in the name or None if it can't be extracted."""
+        res = self.match(name)
+        if res is None:
+            return None
+        return res[1]
 
-        if self.__format is None:
-            # Dropbox Camera Upload format
-            datetime_format = '%Y-%m-%d %H.%M.%S'
+    def parse_paths(self, fpaths):
+        """Extract dates for a list of file paths in one call.
+
+        Return a dict {fpath: datetime} with the paths whose name has a date.
+        """
+        dates = {}
+        parse = self.parse
+        basename = os.path.basename
+        splitext = os.path.splitext
+        for fpath in fpaths:
+            date = parse(splitext(basename(fpath))[0])
+            if date is not None:
+                dates[fpath] = date
+        return dates
+
+
+def _fixed_layout(fmt):
+    """Return (regex, slices, width) for a fixed layout date format, else None.
+
+    slices is a list of (start, end, default) for year, month, day, hour, minute
+    and second. start and end are None for fields not in the format. width is
+    the length of the dates in that format.
+    """
+    regex = []
+    positions = {}
+    pos = 0
+    i = 0
+    while i < len(fmt):
+        token = fmt[i:i + 2]
+        if token in _FIXED_LAYOUT_DIRECTIVES:
+            if token in positions:
+                return None
+            width = _FIXED_LAYOUT_DIRECTIVES[token]
+            positions[token] = (pos, pos + width)
+            regex.append('\\d{%d}' % width)
+            pos += width
+            i += 2
+        elif fmt[i] == '%':
+            # Variable width directive.
+            return None
         else:
-            datetime_format = self.__format
+            regex.append(re.escape(fmt[i]))
+            pos += 1
+            i += 1
 
-        try:
-            date = datetime.strptime(date_string, datetime_format)
-        except Exception:
-            raise PhotoException("{} SourceFileDateFromName: Can't extract date "
-                                 "from file name is compressed.".format(self._fpath))
-        return date
+    if '%Y' not in positions:
+        return None
+
+    defaults = {'%m': 1, '%d': 1}
+    slices = []
+    for token in _FIXED_LAYOUT_DIRECTIVES:
+        start, end = positions.get(token, (None, None))
+        slices.append((start, end, defaults.get(token, 0)))
+    return ''.join(regex), slices, pos
+
+
+DEFAULT_DATE_FROM_NAME = DateFromName()
 
 
 class AbstractRepositoryImporter(object):
     """
     """
-    def __init__(self, source_file, dest_path_callback, dry_run):
+    def __init__(self, source_file, dest_path_callback, dry_run, staging=None,
+                 transfer=TRANSFER_COPY, on_commit_error=None, cache_drop=None,
+                 on_commit=None):
         self._source_file = source_file
         self.__dest_path_callback = dest_path_callback
         self.__dry_run = dry_run
+        self.__staging = staging
+        self.__cache_drop = cache_drop
+        self.__transfer = transfer
+        self.__on_commit_error = on_commit_error
+        self.__on_commit = on_commit
 
         self.__alternate_name_sufix = 0
 
@@ -731,6 +2447,12 @@ class AbstractRepositoryImporter(object):
     def insert(self):
         raise NotImplementedError()
 
+    def _file_exists(self, fpath):
+        """Check if the file exists or it's staged to be committed."""
+        if os.path.isfile(fpath):
+            return True
+        return self.__staging is not None and self.__staging.is_staged(fpath)
+
     def _copy(self, dest_fname):
 
         # Check if destination filename collides with a directory name.
@@ -743,12 +2465,14 @@ class AbstractRepositoryImporter(object):
             self.__copy_dry_run(dest_fname)
         else:
             self.__copy_to_disk(dest_fname)
+        return dest_fpath
 
     def __copy_dry_run(self, dest_fname):
         dest_fpath = os.path.join(self.dest_path(), dest_fname)
         source_fpath = self._source_file.fpath
 
-        print 'DRY COPY', source_fpath, 'TO', dest_fpath
+        print 'DRY {}'.format(self.__transfer.upper()), source_fpath, 'TO', \
+            dest_fpath
 
     def __copy_to_disk(self, dest_fname):
         # Note: In the following code there's a race condition:  if the
@@ -776,15 +2500,34 @@ class AbstractRepositoryImporter(object):
         # Check overwrite permission
         if not ALLOW_OVERWRITE:
             # Overwrite is not allowed. Check if file exists.
-            if os.path.isfile(os.path.join(self.dest_path(), dest_fname)):
+            if self._file_exists(os.path.join(self.dest_path(), dest_fname)):
                 # File exist. Raise error!
                 raise ValueError('File exsit: {}'.format(self.dest_path()))
 
         if not REPO_IS_LOCKED:
-            # copy2: copy file and attributes
-            shutil.copy2(source_fpath, dest_fpath)
-
-            print 'COPY', source_fpath, 'TO', dest_fpath
+            staged = False
+            if self.__transfer == TRANSFER_LINK:
+                os.link(source_fpath, dest_fpath)
+                # Pages read for the hash, if any.
+                _drop_cache(dest_fpath)
+            elif self.__transfer == TRANSFER_MOVE:
+                shutil.move(source_fpath, dest_fpath)
+                _drop_cache(dest_fpath)
+            elif self.__staging is not None:
+                self.__staging.stage(source_fpath, dest_fpath,
+                                     overwrite=ALLOW_OVERWRITE,
+                                     on_error=self.__on_commit_error,
+                                     on_commit=self.__on_commit)
+                staged = True
+            else:
+                # Copy file and attributes, like shutil.copy2.
+                _copy_file(source_fpath, dest_fpath)
+                if self.__cache_drop is not None:
+                    self.__cache_drop.add(dest_fpath)
+
+            print self.__transfer.upper(), source_fpath, 'TO', dest_fpath
+            if not staged and self.__on_commit is not None:
+                self.__on_commit(dest_fpath)
         else:
             raise ValueError('Repository is locked!')
 
@@ -813,7 +2556,8 @@ class RepositoryImporterAlternateName(AbstractRepositoryImporter):
         """
         # Check if destination file exist.
         dest_fname = self._source_file.basename
-        while os.path.isfile(os.path.join(self.dest_path(), dest_fname)):
+        self.__alternate_name_sufix = 0
+        while self._file_exists(os.path.join(self.dest_path(), dest_fname)):
             # File exist. Build an alternate name.
             dest_fname = self.__alternative_filename()
 
@@ -823,7 +2567,7 @@ class RepositoryImporterAlternateName(AbstractRepositoryImporter):
         #     raise ValueError('Error: Destination file is an existing directory:{}'.
         #                      format(dest_fpath))
 
-        self._copy(dest_fname)
+        return self._copy(dest_fname)
 
 
 class RepositoryImporterOverwrite(AbstractRepositoryImporter):
@@ -832,7 +2576,7 @@ class RepositoryImporterOverwrite(AbstractRepositoryImporter):
     def insert(self):
         """
         """
-        self._copy(self._source_file.basename)
+        return self._copy(self._source_file.basename)
 
 
 class RepositoryImporterStrict(AbstractRepositoryImporter):
@@ -849,11 +2593,163 @@ class RepositoryImporterStrict(AbstractRepositoryImporter):
 
         # Check if file exists.
         for fpath in [fpath_lower, fpath_upper]:
-            if os.path.isfile(fpath):
+            if self._file_exists(fpath):
                 raise ImporterFileExistException('{}. File exsit: {}'.format(
                     self.__class__.__name__, fpath))
 
-        self._copy(self._source_file.basename)
+        return self._copy(self._source_file.basename)
+
+
+class StagedCommit(object):
+    """Staged, atomic insert of files with batched durability.
+
+    Files are copied to a hidden temporary name in the destination directory,
+    so a crash never leaves a partial file under its final name. Every
+    batch_size files the batch is committed:
+
+        1. The data of the temporary files is flushed to disk.
+        2. They are renamed to their final names.
+        3. The renames are flushed to disk.
+
+    Flushing is done with a syncfs per file system, two per batch, where it's
+    available (Linux). Otherwise each file and directory is fsynced.
+
+    Temporary files left by a crash can be removed with
+    Repository.remove_staged.
+
+    If the final name of a staged file has been taken by someone else when it's
+    committed, the file is not committed and its on_error callback, given in
+    stage, is called with an ImporterFileExistException. Collisions of files
+    staged without callback are raised by the next call to commit. The
+    on_commit callback of the files committed is called once the batch is
+    durable.
+    """
+    def __init__(self, batch_size=FSYNC_BATCH_SIZE):
+        self.__batch_size = batch_size
+        self.__lock = threading.RLock()
+
+        # [(temporary fpath, dest fpath, overwrite, on_error, on_commit)]
+        self.__staged = []
+        # Lower case dest fpaths of staged files.
+        self.__staged_names = set()
+        # Dest fpaths not committed, of files staged without on_error.
+        self.__collisions = []
+
+    def staging_fpath(self, dest_fpath):
+        path, fname = os.path.split(dest_fpath)
+        return os.path.join(path, '.{}.{}'.format(fname, STAGING_EXT))
+
+    def is_staged(self, dest_fpath):
+        with self.__lock:
+            return dest_fpath.lower() in self.__staged_names
+
+    def stage(self, source_fpath, dest_fpath, overwrite=False, on_error=None,
+              on_commit=None):
+        """Copy the file to its temporary name. Commit if the batch is full.
+
+        :param on_error: callable. Optional. Called with the exception if the
+            file can't be committed.
+        :param on_commit: callable. Optional. Called with dest_fpath when the
+            file has been committed.
+        """
+        tmp_fpath = self.staging_fpath(dest_fpath)
+        try:
+            _copy_file(source_fpath, tmp_fpath)
+        except Exception:
+            if os.path.isfile(tmp_fpath):
+                os.remove(tmp_fpath)
+            raise
+        with self.__lock:
+            self.__staged.append(
+                (tmp_fpath, dest_fpath, overwrite, on_error, on_commit))
+            self.__staged_names.add(dest_fpath.lower())
+            if len(self.__staged) >= self.__batch_size:
+                # Collisions are not raised here: they don't concern the file
+                # being staged.
+                self.__commit_batch()
+
+    def commit(self):
+        """Commit the staged files.
+
+        Raise ImporterFileExistException, after committing the rest of the
+        batch, if destination files of files staged without on_error callback
+        have been created by someone else.
+        """
+        with self.__lock:
+            self.__commit_batch()
+            collisions = self.__collisions
+            self.__collisions = []
+        if collisions:
+            raise ImporterFileExistException(
+                'Staged files not committed. File exsit: {}'.format(
+                    ', '.join(collisions)))
+
+    def __commit_batch(self):
+        """Commit the staged files.
+
+        Files are untracked as they are committed. If a flush or a rename
+        fails, the files not committed yet are kept staged, to be committed
+        or aborted later.
+        """
+        staged = list(self.__staged)
+        if not staged:
+            return
+
+        dirs = set(os.path.dirname(entry[1]) for entry in staged)
+        use_syncfs = _syncfs_available()
+
+        if use_syncfs:
+            _syncfs_dirs(sorted(dirs))
+        else:
+            for entry in staged:
+                _fsync_path(entry[0])
+
+        committed = []
+        for entry in staged:
+            tmp_fpath, dest_fpath, overwrite, on_error, on_commit = entry
+            if overwrite:
+                os.rename(tmp_fpath, dest_fpath)
+                collision = False
+            elif _rename_no_replace(tmp_fpath, dest_fpath):
+                collision = False
+            else:
+                os.remove(tmp_fpath)
+                collision = True
+            self.__staged.remove(entry)
+            self.__staged_names.discard(dest_fpath.lower())
+
+            if not collision:
+                committed.append((dest_fpath, on_commit))
+            elif on_error is None:
+                self.__collisions.append(dest_fpath)
+            else:
+                on_error(ImporterFileExistException(
+                    'Staged file not committed. File exsit: {}'.format(
+                        dest_fpath)))
+
+        if use_syncfs:
+            _syncfs_dirs(sorted(dirs))
+        else:
+            # Directories created by the import have to be flushed in their
+            # parent too, up to the file system root.
+            for path in sorted(_dir_ancestors(dirs), reverse=True):
+                _fsync_path(path)
+
+        for dest_fpath, on_commit in committed:
+            # The data has been flushed: the pages are clean and can be
+            # dropped.
+            _drop_cache(dest_fpath)
+            if on_commit is not None:
+                on_commit(dest_fpath)
+
+    def abort(self):
+        """Remove the staged files not committed."""
+        with self.__lock:
+            for entry in self.__staged:
+                if os.path.isfile(entry[0]):
+                    os.remove(entry[0])
+            self.__staged = []
+            self.__staged_names = set()
 
 
 class DestPath(object):
@@ -886,6 +2782,189 @@ class DestPathFixed(DestPath):
         )
 
 
+class ThumbnailCache(object):
+    """Content addressed thumbnail cache.
+
+    Thumbnails are keyed by the content hash of the image, so moved or renamed
+    files reuse them and changed content gets a new one:
+
+        <path>/<hash[:2]>/<hash>_<width>x<height>.jpg
+
+    They are built in a process pool with PIL draft mode, which decodes JPEGs
+    at a reduced scale instead of at full size.
+
+    The cache size is bounded by max_bytes. When it is exceeded the least
+    recently used thumbnails are evicted. Access time is kept as the file
+    modification time. The cache size is added up once and then updated with
+    every thumbnail built, so the cache directory is only walked to evict.
+
+    The pool is started on the first submit. close() stops it; it's started
+    again if more thumbnails are submitted.
+
+    :param path: str. Cache directory. It's created if it doesn't exist.
+    :param size: (int, int). Optional. Thumbnail bounding box.
+    :param max_bytes: int. Optional. Maximum cache size. Default unbounded.
+    :param processes: int. Optional. Pool size. Default number of CPUs.
+    """
+    def __init__(self, path, size=THUMBNAIL_SIZE, max_bytes=None,
+                 quality=THUMBNAIL_QUALITY, processes=None):
+        self.__path = path
+        self.__size = tuple(size)
+        self.__max_bytes = max_bytes
+        self.__quality = quality
+        self.__processes = processes
+
+        self.__pool = None
+        # [(thumbnail path, AsyncResult)]
+        self.__pending = []
+        # [(source fpath, error message)]
+        self.__errors = []
+        # Cache size in bytes. None until needed, see __cache_bytes.
+        self.__bytes = None
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    @property
+    def path(self):
+        return self.__path
+
+    def errors(self):
+        return self.__errors
+
+    def thumbnail_path(self, sf_hash):
+        return os.path.join(
+            self.__path, sf_hash[:2],
+            '{}_{}x{}.jpg'.format(sf_hash, self.__size[0], self.__size[1]))
+
+    def get(self, sf_hash):
+        """Return the thumbnail path for the content hash or None if missing."""
+        tpath = self.thumbnail_path(sf_hash)
+        try:
+            os.utime(tpath, None)
+        except OSError:
+            return None
+        return tpath
+
+    def submit(self, fpath, sf_hash):
+        """Build the thumbnail of fpath in background if it's not cached."""
+        if self.get(sf_hash) is not None:
+            return
+        if self.__pool is None:
+            import multiprocessing
+            self.__pool = multiprocessing.Pool(self.__processes)
+        tpath = self.thumbnail_path(sf_hash)
+        self.__pending.append((tpath, self.__pool.apply_async(
+            _make_thumbnail, ((fpath, tpath, self.__size, self.__quality),))))
+        if len(self.__pending) > 1024:
+            self.__collect(wait=False)
+
+    def __collect(self, wait):
+        """Collect the built thumbnails and evict if over max_bytes."""
+        if self.__max_bytes is not None:
+            # The size has to be known to be kept up to date.
+            self.__cache_bytes()
+        pending = []
+        for tpath, res in self.__pending:
+            if wait or res.ready():
+                error = res.get()
+                if error is not None:
+                    self.__errors.append(error)
+                elif self.__bytes is not None:
+                    try:
+                        self.__bytes += os.path.getsize(tpath)
+                    except OSError:
+                        # Not an image: no thumbnail.
+                        pass
+            else:
+                pending.append((tpath, res))
+        self.__pending = pending
+        if (self.__max_bytes is not None and
+                self.__bytes > self.__max_bytes):
+            self.evict()
+
+    def __cache_bytes(self):
+        if self.__bytes is None:
+            self.__bytes = sum(size for _, size, _ in self.__entries())
+        return self.__bytes
+
+    def join(self):
+        """Wait for the submitted thumbnails and evict if over max_bytes."""
+        self.__collect(wait=True)
+
+    def close(self):
+        self.join()
+        if self.__pool is not None:
+            self.__pool.close()
+            self.__pool.join()
+            self.__pool = None
+
+    def __entries(self):
+        """Return [(mtime, size, path)] for all the thumbnails."""
+        entries = []
+        for tpath in files_in_folder(self.__path):
+            try:
+                st = os.stat(tpath)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, tpath))
+        return entries
+
+    def evict(self):
+        """Remove least recently used thumbnails until under max_bytes."""
+        if self.__max_bytes is None:
+            return
+        entries = self.__entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, tpath in sorted(entries):
+            if total <= self.__max_bytes:
+                break
+            os.remove(tpath)
+            total -= size
+        self.__bytes = total
+
+    def purge(self, hashes):
+        """Remove thumbnails whose content hash is not in hashes."""
+        for _, size, tpath in self.__entries():
+            sf_hash = os.path.basename(tpath).split('_')[0]
+            if sf_hash not in hashes:
+                os.remove(tpath)
+                if self.__bytes is not None:
+                    self.__bytes -= size
+
+
+def _make_thumbnail(args):
+    """Build a thumbnail. Run in a ThumbnailCache pool worker.
+
+    Return None or (source fpath, error message) if it can't be built.
+    """
+    from PIL import Image
+    fpath, tpath, size, quality = args
+    if sniff_file_type(fpath) not in THUMBNAIL_FILE_TYPES:
+        return None
+    try:
+        img = Image.open(fpath)
+        # Let the JPEG decoder scale down while decoding.
+        img.draft('RGB', size)
+        img.thumbnail(size, Image.ANTIALIAS)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        tdir = os.path.dirname(tpath)
+        try:
+            os.makedirs(tdir)
+        except OSError:
+            if not os.path.isdir(tdir):
+                raise
+        # Write and rename, so a partial thumbnail is never visible.
+        tmp_tpath = '{}.{}.tmp'.format(tpath, os.getpid())
+        img.save(tmp_tpath, 'JPEG', quality=quality)
+        os.rename(tmp_tpath, tpath)
+    except Exception, ex:
+        return fpath, '{}: {}'.format(type(ex).__name__, ex)
+    return None
+
+
 def equal(im1, im2):
     """
 
@@ -895,6 +2974,7 @@ def equal(im1, im2):
 
     See also the method hash().
     """
+    from PIL import ImageChops
     return ImageChops.difference(im1, im2).getbbox() is None
 
 
@@ -906,6 +2986,7 @@ def hash(im1, im2):
 
     This is x30 faster than the method equals().
     """
+    import hashlib
     with open(im1, 'r') as f1:
         hasher = hashlib.md5()
         hasher.update(f1.read())
@@ -917,6 +2998,451 @@ def hash(im1, im2):
     return hsh1 == hsh2
 
 
+# File type detection.
+#
+# The file type is identified from the first FILE_TYPE_HEADER_SIZE bytes of
+# the file: magic numbers and, for ISO base media files (MOV, MP4, HEIC), the
+# major brand in the 'ftyp' box.
+FILE_TYPE_HEADER_SIZE = 16
+
+# (offset, magic bytes, file type)
+FILE_TYPE_SIGNATURES = [
+    (0, '\xff\xd8\xff', 'jpeg'),
+    (0, '\x89PNG\r\n\x1a\n', 'png'),
+    (0, 'GIF87a', 'gif'),
+    (0, 'GIF89a', 'gif'),
+    (0, 'II*\x00', 'tiff'),
+    (0, 'MM\x00*', 'tiff'),
+]
+
+# 'ftyp' major brand to file type. Unknown brands are taken as 'mp4'.
+FTYP_BRANDS = {
+    'qt  ': 'mov',
+    'isom': 'mp4',
+    'iso2': 'mp4',
+    'mp41': 'mp4',
+    'mp42': 'mp4',
+    'avc1': 'mp4',
+    'M4V ': 'mp4',
+    '3gp4': 'mp4',
+    '3gp5': 'mp4',
+    'heic': 'heic',
+    'heix': 'heic',
+    'hevc': 'heic',
+    'mif1': 'heic',
+    'msf1': 'heic',
+}
+
+# Top level atoms which start classic QuickTime files, with no 'ftyp' atom,
+# like the .mov files of older cameras.
+QUICKTIME_ATOMS = ['moov', 'mdat', 'wide', 'free', 'skip', 'pnot']
+
+# File type to SourceFile class. See register_file_type.
+FILE_TYPE_HANDLERS = {}
+
+
+def register_file_type(file_type, source_file_class):
+    """Register the SourceFile class which handles the given file type.
+
+    register_file_type('jpeg', SourceFileEXIF)
+    """
+    FILE_TYPE_HANDLERS[file_type] = source_file_class
+
+
+def sniff_file_type(fpath):
+    """Return the file type from the file header or None if it is unknown."""
+    try:
+        with open(fpath, 'rb') as f:
+            header = f.read(FILE_TYPE_HEADER_SIZE)
+    except IOError:
+        return None
+
+    for offset, magic, file_type in FILE_TYPE_SIGNATURES:
+        if header[offset:offset + len(magic)] == magic:
+            return file_type
+
+    if header[4:8] == 'ftyp':
+        return FTYP_BRANDS.get(header[8:12], 'mp4')
+    if header[4:8] in QUICKTIME_ATOMS:
+        return 'mov'
+
+    return None
+
+
+def file_type_handler(file_type, factory=None):
+    """Return the SourceFile class for the file type, None if unsupported.
+
+    factory is an optional dict {file_type: SourceFile class} which takes
+    precedence over the registered handlers.
+    """
+    if factory is not None and file_type in factory:
+        return factory[file_type]
+    return FILE_TYPE_HANDLERS.get(file_type)
+
+
+def source_file_factory(fpath, factory=None, file_type=None):
+    """Build the concrete SourceFile for the given file path.
+
+    Files with an unsupported type are returned as generic SourceFile.
+    """
+    if file_type is None:
+        file_type = sniff_file_type(fpath)
+    source_file_class = file_type_handler(file_type, factory)
+    if source_file_class is None:
+        source_file_class = SourceFile
+    return source_file_class(fpath, file_type=file_type)
+
+
+register_file_type('jpeg', SourceFileEXIF)
+register_file_type('mov', SourceFileMPEG4)
+register_file_type('mp4', SourceFileMPEG4)
+
+
+def _filter_fname(db_fname):
+    """Content filter file name for the DB file name: repo.pkl -> repo.filter.pkl"""
+    name, ext = os.path.splitext(db_fname)
+    return name + '.filter' + ext
+
+
+def _merge_join(items1, items2):
+    """Join two sorted streams of (key, value) with unique keys.
+
+    Yield (key, value1, value2) for every key in any of them. The value is None
+    if the key is missing in that stream.
+    """
+    items1 = iter(items1)
+    items2 = iter(items2)
+    item1 = next(items1, None)
+    item2 = next(items2, None)
+    while item1 is not None or item2 is not None:
+        if item2 is None or (item1 is not None and item1[0] < item2[0]):
+            yield item1[0], item1[1], None
+            item1 = next(items1, None)
+        elif item1 is None or item2[0] < item1[0]:
+            yield item2[0], None, item2[1]
+            item2 = next(items2, None)
+        else:
+            yield item1[0], item1[1], item2[1]
+            item1 = next(items1, None)
+            item2 = next(items2, None)
+
+
+def _md5_file(fpath, chunk_size=HASH_CHUNK_SIZE, limiter=None,
+              drop_cache=False):
+    """MD5 hex digest of the file, read in chunks.
+
+    If a RateLimiter is given, it's acquired for every chunk read. If
+    drop_cache is True, the file pages are dropped from the page cache after
+    reading it.
+    """
+    import hashlib
+    hasher = hashlib.md5()
+    with open(fpath, 'rb') as f:
+        _fadvise(f, POSIX_FADV_SEQUENTIAL)
+        _fadvise(f, POSIX_FADV_WILLNEED)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            if limiter is not None:
+                limiter.acquire(len(chunk))
+            hasher.update(chunk)
+        if drop_cache:
+            _fadvise(f, POSIX_FADV_DONTNEED)
+    return hasher.hexdigest()
+
+
+def _copy_file(src, dst):
+    """Copy file data and attributes, like shutil.copy2, with I/O hints.
+
+    The source is read sequentially and its pages are dropped from the page
+    cache when copied. The write out of the destination is started, without
+    waiting for it: its pages can be dropped later, once clean. See
+    DeferredCacheDrop.
+    """
+    with open(src, 'rb') as fsrc:
+        _fadvise(fsrc, POSIX_FADV_SEQUENTIAL)
+        _fadvise(fsrc, POSIX_FADV_WILLNEED)
+        with open(dst, 'wb') as fdst:
+            shutil.copyfileobj(fsrc, fdst, HASH_CHUNK_SIZE)
+            fdst.flush()
+            _write_out(fdst)
+        _fadvise(fsrc, POSIX_FADV_DONTNEED)
+    shutil.copystat(src, dst)
+
+
+def _drop_cache(fpath):
+    """Drop the clean pages of the file from the page cache."""
+    if not IO_HINTS:
+        return
+    try:
+        with open(fpath, 'rb') as f:
+            _fadvise(f, POSIX_FADV_DONTNEED)
+    except IOError:
+        pass
+
+
+def _write_out(f):
+    """Start writing the dirty pages of the open file to disk.
+
+    It doesn't wait for it. It uses sync_file_range where it's available
+    (Linux), no-op otherwise or if IO_HINTS is off. Durability is left to the
+    commit.
+    """
+    if not IO_HINTS:
+        return
+    libc = _load_libc()
+    if not libc or not hasattr(libc, 'sync_file_range'):
+        return
+    import ctypes
+    libc.sync_file_range.argtypes = [
+        ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_uint]
+    # It's only a hint. Errors are ignored.
+    libc.sync_file_range(f.fileno(), 0, 0, SYNC_FILE_RANGE_WRITE)
+
+
+class DeferredCacheDrop(object):
+    """Drop the pages of written files from the page cache, some files later.
+
+    Only clean pages can be dropped. The write out started when a file is
+    copied has the time of the next lag files to complete, so the pages of a
+    file are dropped when lag more files have been added. Pages still dirty
+    are kept by the kernel.
+    """
+    def __init__(self, lag=FSYNC_BATCH_SIZE):
+        self.__lag = lag
+        self.__lock = threading.Lock()
+        self.__fpaths = collections.deque()
+
+    def add(self, fpath):
+        with self.__lock:
+            self.__fpaths.append(fpath)
+            if len(self.__fpaths) <= self.__lag:
+                return
+            fpath = self.__fpaths.popleft()
+        _drop_cache(fpath)
+
+    def flush(self):
+        """Drop the pages of all the files added."""
+        with self.__lock:
+            fpaths = list(self.__fpaths)
+            self.__fpaths.clear()
+        for fpath in fpaths:
+            _drop_cache(fpath)
+
+
+def _fadvise(f, advice, offset=0, length=0):
+    """posix_fadvise on the open file. No-op if not available or IO_HINTS off.
+
+    length 0 means up to the end of the file.
+    """
+    if not IO_HINTS:
+        return
+    libc = _load_libc()
+    if not libc or not hasattr(libc, 'posix_fadvise'):
+        return
+    import ctypes
+    libc.posix_fadvise.argtypes = [
+        ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong, ctypes.c_int]
+    # It's only a hint. Errors are ignored.
+    libc.posix_fadvise(f.fileno(), offset, length, advice)
+
+
+# struct fiemap with room for one struct fiemap_extent. See
+# Documentation/filesystems/fiemap.txt in the Linux sources.
+_FS_IOC_FIEMAP = 0xC020660B
+_FIEMAP_HEADER = struct.Struct('=QQIIII')
+_FIEMAP_EXTENT = struct.Struct('=QQQQQIIII')
+
+
+def _first_physical_offset(fd):
+    """Physical offset of the first extent of the file or None."""
+    import array
+    import fcntl
+    # ioctl needs a mutable buffer with the old buffer interface.
+    buf = array.array('B', [0] * (_FIEMAP_HEADER.size + _FIEMAP_EXTENT.size))
+    # fm_start=0, fm_length=all, fm_flags=0, fm_extent_count=1
+    _FIEMAP_HEADER.pack_into(buf, 0, 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0)
+    try:
+        fcntl.ioctl(fd, _FS_IOC_FIEMAP, buf, True)
+    except IOError:
+        return None
+    mapped_extents = _FIEMAP_HEADER.unpack_from(buf, 0)[3]
+    if not mapped_extents:
+        return None
+    return _FIEMAP_EXTENT.unpack_from(buf, _FIEMAP_HEADER.size)[1]
+
+
+def physical_order(fpaths):
+    """Sort file paths by their location on disk.
+
+    Files are sorted by device and by the physical offset of their first
+    extent, where the file system reports it (FIEMAP), or else by inode
+    number, which on most file systems follows the disk layout. Reading files
+    in this order reduces seeks on spinning disks.
+    """
+    keys = {}
+    for fpath in fpaths:
+        try:
+            fd = os.open(fpath, os.O_RDONLY)
+        except OSError:
+            keys[fpath] = (0, 0, 0, fpath)
+            continue
+        try:
+            st = os.fstat(fd)
+            offset = _first_physical_offset(fd)
+        finally:
+            os.close(fd)
+        if offset is None:
+            keys[fpath] = (st.st_dev, 1, st.st_ino, fpath)
+        else:
+            keys[fpath] = (st.st_dev, 0, offset, fpath)
+    return sorted(fpaths, key=keys.__getitem__)
+
+
+def _rename_no_replace(src, dst):
+    """Rename src to dst atomically if dst doesn't exist.
+
+    Return False if dst exists. Where hard links are not supported, it falls
+    back to a check and rename, which is not atomic.
+    """
+    try:
+        os.link(src, dst)
+    except OSError, ex:
+        if ex.errno == errno.EEXIST:
+            return False
+        if ex.errno not in (errno.EPERM, errno.ENOTSUP, errno.EXDEV,
+                            errno.EMLINK):
+            raise
+        if os.path.exists(dst):
+            return False
+        os.rename(src, dst)
+        return True
+    os.remove(src)
+    return True
+
+
+def _dir_ancestors(dirs):
+    """Return the set of dirs and their parents up to the mount point."""
+    ancestors = set()
+    for path in dirs:
+        path = os.path.abspath(path)
+        while path not in ancestors:
+            ancestors.add(path)
+            if os.path.ismount(path):
+                break
+            path = os.path.dirname(path)
+    return ancestors
+
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+_libc = None
+
+
+def _load_libc():
+    """Return the C library with ctypes, or False if it can't be loaded."""
+    global _libc
+    if _libc is None:
+        import ctypes
+        import ctypes.util
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        except OSError:
+            _libc = False
+    return _libc
+
+
+def _syncfs_available():
+    libc = _load_libc()
+    return bool(libc) and hasattr(libc, 'syncfs')
+
+
+def _syncfs_dirs(dirs):
+    """syncfs once per file system of the given directories."""
+    import ctypes
+    synced = set()
+    for path in dirs:
+        st_dev = os.stat(path).st_dev
+        if st_dev in synced:
+            continue
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            if _libc.syncfs(fd) != 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err), path)
+        finally:
+            os.close(fd)
+        synced.add(st_dev)
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('NumPy is required for the repository catalog.')
+    return numpy
+
+
+def _catalog_dtype(path_len):
+    return [
+        ('path', 'S{}'.format(path_len)),
+        ('size', 'i8'),
+        ('hash', 'S32'),
+        ('date', 'M8[s]'),
+        ('type', 'S8'),
+        ('make', 'S32'),
+        ('model', 'S32'),
+        ('iso', 'i4'),
+        ('width', 'i4'),
+        ('height', 'i4'),
+    ]
+
+
+def _exif_str(value):
+    if value is None:
+        return ''
+    return str(value).strip('\x00 ')[:32]
+
+
+def _exif_int(value):
+    # Some tags are tuples, like ISOSpeedRatings in some cameras.
+    if isinstance(value, (tuple, list)):
+        value = value[0] if value else None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _counter_sub(counter, key, n):
+    """Subtract n from counter[key], removing the key when it gets to 0."""
+    counter[key] -= n
+    if counter[key] == 0:
+        del counter[key]
+
+
+def _error_message(exc):
+    """'ExceptionClass: message'"""
+    return u'{}: {}'.format(type(exc).__name__, _exception_message(exc))
+
+
+def _exception_message(exc):
+    try:
+        return unicode(exc)
+    except Exception:
+        try:
+            return str(exc).decode('utf8', 'replace')
+        except Exception:
+            return repr(exc)
+
+
 def _check_path(path):
     if path is None:
         raise ValueError('Path cannot be None.')
@@ -998,22 +3524,226 @@ def duplicates_in_list(lst):
     return d
 
 
-def insert(path):
-    sfm = SourceFilesManger(path)
-    repo = Repository('/home/sergi/Dropbox/python/app/photometa/respo_test')
-    rm = RepositoryManager(repo, sfm)
-    rm.insert()
-    return sfm
+def configure_logging(log_dir=LOG_DIR):
+    """Attach the handlers of the transaction and error logs.
 
-def check_input(path):
-    sfm = SourceFilesManger(path, exclude_ext=['png', 'gif'])
-    sfm.check()
-    return sfm
+    It's done once, the first time it's called.
+    """
+    logging_conf.logger_factory('logger_err', log_dir=log_dir,
+                                max_repeats=LOG_ERROR_REPEATS)
+    logging_conf.logger_factory('logger_trans', log_dir=log_dir)
 
-if __name__ == '__main__':
-    sfm = SourceFilesManger('/home/sergi/Pictures/2010')
-    repo = Repository('/home/sergi/Dropbox/Fotos')
-    # sfm = SourceFilesManger('/home/sergi/Desktop/Photos_1')
-    # repo = Repository('/home/sergi/Desktop/Photos_2')
-    mng = RepositoryManager(repo, sfm)
 
+def _load_db(repo, args):
+    """Load the repository DB for a command if it has been saved."""
+    if os.path.isfile(os.path.join(args.db_dir, args.db_name)):
+        repo.db_load(args.db_dir, args.db_name, lazy=True)
+        return True
+    return False
+
+
+def _source_kwargs(args):
+    date_from_name = DEFAULT_DATE_FROM_NAME if args.date_from_name else None
+    return dict(exclude_ext=args.exclude_ext,
+                skip_unsupported=args.skip_unsupported,
+                date_from_name=date_from_name, io_order=args.io_order)
+
+
+def _source_fm(path, args):
+    return SourceFilesManger(path, **_source_kwargs(args))
+
+
+def _cmd_scan(args):
+    sfm = _source_fm(args.source, args)
+    for ext, count in sorted(sfm.describe()):
+        print '{}\t{}'.format(ext, count)
+    for path, count in sfm.describe_paths():
+        print '{}\t{}'.format(path, count)
+
+
+def _cmd_check(args):
+    _source_fm(args.source, args).check()
+
+
+def _make_db_dir(args):
+    """Create the DB directory, before a long scan, if it doesn't exist."""
+    if not os.path.isdir(args.db_dir):
+        os.makedirs(args.db_dir)
+
+
+def _cmd_db_scan(args):
+    _make_db_dir(args)
+    repo = Repository(args.repo)
+    repo.db_scan()
+    repo.db_save(args.db_dir, args.db_name)
+    print 'Files in DB: {}'.format(len(repo.db))
+
+
+def _cmd_import(args):
+    global REPO_IS_LOCKED
+    if args.unlock:
+        REPO_IS_LOCKED = False
+    repo = Repository(args.repo, staged=args.staged,
+                      fsync_batch=args.fsync_batch)
+    _load_db(repo, args)
+    if len(args.sources) == 1:
+        mng = RepositoryManager(repo, _source_fm(args.sources[0], args))
+    else:
+        # Sources are loaded by the workers of their device.
+        mng = MultiSourceRepositoryManager(
+            repo, args.sources, workers_per_device=args.workers_per_device,
+            source_kwargs=_source_kwargs(args))
+    mng.insert_strict(dry_run=args.dry_run)
+
+
+def _cmd_dedupe(args):
+    repo = Repository(args.repo)
+    if not _load_db(repo, args):
+        repo.db_scan()
+    total_dup = 0
+    for sf in _source_fm(args.source, args).files:
+        try:
+            repo.content_exist(sf)
+        except ImporterDuplicateContentException, ex:
+            total_dup += 1
+            print '{}\t{}'.format(sf.fpath, ex.message)
+    print 'Duplicate files: {}'.format(total_dup)
+
+
+def _cmd_merge(args):
+    global REPO_IS_LOCKED
+    if args.unlock:
+        REPO_IS_LOCKED = False
+    if not args.dry_run:
+        _make_db_dir(args)
+    repo = Repository(args.repo)
+    if not _load_db(repo, args):
+        repo.db_scan()
+    source_repo = Repository(args.source)
+    if args.source_db is not None:
+        source_repo.db_load(*os.path.split(args.source_db))
+    else:
+        source_repo.db_scan()
+    merge_report = repo.merge(source_repo, transfer=args.transfer,
+                              alternate_names=args.alternate_names,
+                              dry_run=args.dry_run)
+    for sf_hash, source_fpath, target_fpath in merge_report.duplicates:
+        print '{}\t{}'.format(source_fpath, target_fpath)
+    merge_report.report()
+    if not args.dry_run:
+        repo.db_save(args.db_dir, args.db_name)
+
+
+def _cmd_report(args):
+    repo = Repository(args.repo)
+    index = repo.date_index
+    total = 0
+    for year, month in index.months():
+        count = len(files_in_folder(index.month_path(year, month),
+                                    recursive=False,
+                                    exclude_ext=[STAGING_EXT]))
+        total += count
+        print '{:04d}-{:02d}\t{}'.format(year, month, count)
+    print 'Total files: {}'.format(total)
+
+
+def main(argv=None):
+    """Command line interface.
+
+        python photometa.py scan SOURCE
+        python photometa.py check SOURCE
+        python photometa.py db-scan REPO
+        python photometa.py import REPO SOURCE [SOURCE ...] [--dry-run]
+        python photometa.py dedupe REPO SOURCE
+        python photometa.py merge REPO SOURCE_REPO [--dry-run]
+        python photometa.py report REPO
+    """
+    import argparse
+
+    parser = argparse.ArgumentParser(prog='photometa')
+    parser.add_argument('--log-dir', default=LOG_DIR)
+    parser.add_argument('--db-dir', default='./db/')
+    parser.add_argument('--db-name', default='repo.pkl')
+    subparsers = parser.add_subparsers()
+
+    source_args = argparse.ArgumentParser(add_help=False)
+    source_args.add_argument('--exclude-ext', nargs='*', default=None)
+    source_args.add_argument('--skip-unsupported', action='store_true')
+    source_args.add_argument('--date-from-name', action='store_true',
+                             help='Take dates from Dropbox style file names.')
+    source_args.add_argument('--io-order', default=IO_ORDER_WALK,
+                             choices=[IO_ORDER_WALK, IO_ORDER_PHYSICAL],
+                             help='Order files are read in.')
+
+    cmd = subparsers.add_parser('scan', parents=[source_args],
+                                help='Describe the files in a source.')
+    cmd.add_argument('source')
+    cmd.set_defaults(func=_cmd_scan)
+
+    cmd = subparsers.add_parser('check', parents=[source_args],
+                                help='Check dates can be read from a source.')
+    cmd.add_argument('source')
+    cmd.set_defaults(func=_cmd_check)
+
+    cmd = subparsers.add_parser('db-scan',
+                                help='Build and save the repository DB.')
+    cmd.add_argument('repo')
+    cmd.set_defaults(func=_cmd_db_scan)
+
+    cmd = subparsers.add_parser('import', parents=[source_args],
+                                help='Strict insert of sources into the '
+                                     'repository.')
+    cmd.add_argument('repo')
+    cmd.add_argument('sources', nargs='+')
+    cmd.add_argument('--dry-run', action='store_true')
+    cmd.add_argument('--unlock', action='store_true',
+                     help='Allow writing to the repository.')
+    cmd.add_argument('--workers-per-device', type=int, default=1)
+    cmd.add_argument('--staged', action='store_true',
+                     help='Copy to temporary names and rename into place '
+                          'in batches.')
+    cmd.add_argument('--fsync-batch', type=int, default=FSYNC_BATCH_SIZE)
+    cmd.set_defaults(func=_cmd_import)
+
+    cmd = subparsers.add_parser('dedupe', parents=[source_args],
+                                help='List source files whose content is '
+                                     'already in the repository.')
+    cmd.add_argument('repo')
+    cmd.add_argument('source')
+    cmd.set_defaults(func=_cmd_dedupe)
+
+    cmd = subparsers.add_parser('merge',
+                                help='Insert the content of another '
+                                     'repository missing in the repository.')
+    cmd.add_argument('repo')
+    cmd.add_argument('source')
+    cmd.add_argument('--source-db', default=None,
+                     help='Saved DB of the source repository.')
+    cmd.add_argument('--transfer', default=TRANSFER_COPY,
+                     choices=[TRANSFER_COPY, TRANSFER_LINK, TRANSFER_MOVE])
+    cmd.add_argument('--alternate-names', action='store_true',
+                     help='Insert files whose name exists with different '
+                          'content with an alternate name.')
+    cmd.add_argument('--dry-run', action='store_true')
+    cmd.add_argument('--unlock', action='store_true',
+                     help='Allow writing to the repository.')
+    cmd.set_defaults(func=_cmd_merge)
+
+    cmd = subparsers.add_parser('report',
+                                help='Files per month in the repository.')
+    cmd.add_argument('repo')
+    cmd.set_defaults(func=_cmd_report)
+
+    args = parser.parse_args(argv)
+    if args.func in (_cmd_import, _cmd_dedupe, _cmd_merge):
+        configure_logging(args.log_dir)
+    try:
+        args.func(args)
+    except ValueError, ex:
+        print >> sys.stderr, 'Error: {}'.format(ex)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+# -*- coding: utf8 -*-
+"""
+Tests for Repository.merge.
+
+    python -m unittest test_merge
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import photometa
+from photometa import Repository
+from photometa import STAGING_EXT
+from photometa import files_in_folder
+
+
+class MergeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_is_locked = photometa.REPO_IS_LOCKED
+        photometa.REPO_IS_LOCKED = False
+        self.tmp = tempfile.mkdtemp()
+        self.target_path = os.path.join(self.tmp, 'target')
+        self.source_path = os.path.join(self.tmp, 'source')
+
+        self.write(self.target_path, '2016/08/a.jpg', 'content a')
+        self.write(self.source_path, '2016/08/a.jpg', 'content a')
+        self.write(self.source_path, '2016/08/b.jpg', 'content b')
+        self.write(self.source_path, '2016/09/c.mp4', 'content c')
+
+        self.source = Repository(self.source_path)
+        self.source.db_scan()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        photometa.REPO_IS_LOCKED = self.repo_is_locked
+
+    def write(self, repo_path, rel_fpath, content):
+        fpath = os.path.join(repo_path, rel_fpath)
+        if not os.path.isdir(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        with open(fpath, 'wb') as f:
+            f.write(content)
+
+    def read(self, repo_path, rel_fpath):
+        with open(os.path.join(repo_path, rel_fpath), 'rb') as f:
+            return f.read()
+
+    def test_merge_into_staged_repository(self):
+        target = Repository(self.target_path, staged=True)
+        target.db_scan()
+
+        report = target.merge(self.source)
+
+        self.assertEqual(report.errors, [])
+        self.assertEqual(len(report.inserted), 2)
+        self.assertEqual(len(report.duplicates), 1)
+        self.assertEqual(self.read(self.target_path, '2016/08/b.jpg'),
+                         'content b')
+        self.assertEqual(self.read(self.target_path, '2016/09/c.mp4'),
+                         'content c')
+        self.assertEqual(
+            [fpath for fpath in files_in_folder(self.target_path)
+             if fpath.endswith(STAGING_EXT)], [])
+        # The content filter knows the merged files.
+        self.assertEqual(len(target.db), 3)
+
+    def test_merge_with_stale_source_db(self):
+        target = Repository(self.target_path)
+        target.db_scan()
+        # Removed after the source DB was built.
+        os.remove(os.path.join(self.source_path, '2016/08/b.jpg'))
+
+        report = target.merge(self.source)
+
+        self.assertEqual(len(report.errors), 1)
+        self.assertEqual(report.errors[0][0],
+                         os.path.join(self.source_path, '2016/08/b.jpg'))
+        self.assertEqual([dest for _, _, dest in report.inserted],
+                         [os.path.join(self.target_path, '2016/09/c.mp4')])
+        self.assertEqual(self.read(self.target_path, '2016/09/c.mp4'),
+                         'content c')
+        self.assertEqual(len(target.db), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
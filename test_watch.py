@@ -0,0 +1,109 @@
+# -*- coding: utf8 -*-
+"""
+Tests for watch mode. Linux only, inotify is required.
+
+    python -m unittest test_watch
+"""
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import photometa
+from photometa import DEFAULT_DATE_FROM_NAME
+from photometa import Repository
+from watch import DropFolderWatcher
+
+
+SETTLE = 0.2
+
+# JPEG header followed by some data. The date is taken from the file name.
+CONTENT = '\xff\xd8\xff\xe0' + 'photo data ' * 100
+FNAME = '2016-08-23 14.23.15.jpg'
+
+
+class DropFolderWatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.repo_is_locked = photometa.REPO_IS_LOCKED
+        photometa.REPO_IS_LOCKED = False
+        self.tmp = tempfile.mkdtemp()
+        self.repo_path = os.path.join(self.tmp, 'repo')
+        self.drop_path = os.path.join(self.tmp, 'drop')
+        os.makedirs(self.repo_path)
+        os.makedirs(self.drop_path)
+        self.cwd = os.getcwd()
+        # Insert logs are written to the working directory.
+        os.chdir(self.tmp)
+
+        self.watcher = DropFolderWatcher(
+            Repository(self.repo_path), self.drop_path, settle=SETTLE,
+            date_from_name=DEFAULT_DATE_FROM_NAME)
+        self.watcher.start()
+
+    def tearDown(self):
+        self.watcher.stop()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+        photometa.REPO_IS_LOCKED = self.repo_is_locked
+
+    def poll_settled(self):
+        """Poll until the settle time of the last change has passed."""
+        inserted = self.watcher.poll()
+        time.sleep(SETTLE * 2)
+        return inserted + self.watcher.poll() + self.watcher.poll()
+
+    def repo_fpath(self):
+        return os.path.join(self.repo_path, '2016', '08', FNAME)
+
+    def test_closed_file_is_inserted(self):
+        fpath = os.path.join(self.drop_path, FNAME)
+        with open(fpath, 'wb') as f:
+            f.write(CONTENT)
+
+        self.assertEqual(self.poll_settled(), [fpath])
+        with open(self.repo_fpath(), 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+
+    def test_stalled_writer_is_not_inserted(self):
+        fpath = os.path.join(self.drop_path, FNAME)
+        f = open(fpath, 'wb')
+        try:
+            f.write(CONTENT[:13])
+            f.flush()
+            # Writer stalls for longer than the settle time.
+            self.assertEqual(self.poll_settled(), [])
+            self.assertFalse(os.path.exists(self.repo_fpath()))
+            self.assertEqual(self.watcher.pending(), [fpath])
+
+            f.write(CONTENT[13:])
+        finally:
+            f.close()
+
+        self.assertEqual(self.poll_settled(), [fpath])
+        with open(self.repo_fpath(), 'rb') as f:
+            self.assertEqual(f.read(), CONTENT)
+        self.assertEqual(self.watcher.manager.results().count_error, 0)
+
+    def test_rescan_skips_seen_files(self):
+        existing = os.path.join(self.drop_path, 'existing.jpg')
+        with open(existing, 'wb') as f:
+            f.write(CONTENT)
+        self.watcher.stop()
+        # Files found when the watch starts are not inserted.
+        self.watcher.start()
+
+        fpath = os.path.join(self.drop_path, FNAME)
+        with open(fpath, 'wb') as f:
+            f.write(CONTENT)
+        self.assertEqual(self.poll_settled(), [fpath])
+
+        # A rescan, as done on events queue overflow, queues nothing.
+        self.watcher._DropFolderWatcher__watch_tree(
+            self.drop_path, queue_files=True)
+        self.assertEqual(self.watcher.pending(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
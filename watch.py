@@ -0,0 +1,310 @@
+# -*- coding: utf8 -*-
+"""
+Watch mode
+
+Continuous ingest of drop folders, like Dropbox Camera Uploads. New files in
+the source directory are detected with inotify and, once they are complete,
+inserted into the repository through Repository.insert. Existing files are
+not rescanned.
+
+    repo = Repository('/home/sergi/Dropbox/Fotos')
+    repo.db_load(lazy=True)
+    watcher = DropFolderWatcher(repo, '/home/sergi/Dropbox/Camera Uploads',
+                                date_from_name=DEFAULT_DATE_FROM_NAME)
+    watcher.run()
+
+Linux only.
+"""
+import os
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from photometa import RepositoryManager
+from photometa import SourceFileDateFromName
+from photometa import file_type_handler
+from photometa import sniff_file_type
+from photometa import source_file_factory
+
+
+# inotify event masks. See inotify(7).
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+
+# Events watched in every directory.
+WATCH_MASK = (IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_MOVED_FROM |
+              IN_CREATE | IN_DELETE | IN_DELETE_SELF)
+
+# struct inotify_event: wd, mask, cookie, len. Followed by len bytes of name.
+_EVENT_HEADER = struct.Struct('iIII')
+
+# Seconds a file has to stay unchanged before it is inserted.
+DEFAULT_SETTLE = 2.0
+
+
+class Inotify(object):
+    """Minimal inotify binding.
+
+    Watches are added by directory. read() returns a list of
+    (directory path, mask, file name) events.
+    """
+    def __init__(self):
+        self.__libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.__fd = self.__libc.inotify_init1(IN_CLOEXEC)
+        if self.__fd < 0:
+            self.__raise_errno()
+
+        # Watch descriptor to directory path.
+        self.__paths = {}
+
+    def __raise_errno(self, path=None):
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    def fileno(self):
+        return self.__fd
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        wd = self.__libc.inotify_add_watch(self.__fd, path, mask)
+        if wd < 0:
+            self.__raise_errno(path)
+        self.__paths[wd] = path
+        return wd
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for events and return them."""
+        ready, _, _ = select.select([self.__fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.__fd, 64 * 1024)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+
+            path = self.__paths.get(wd)
+            if mask & IN_IGNORED:
+                # Watch removed: directory deleted or unmounted.
+                self.__paths.pop(wd, None)
+            if path is not None or mask & IN_Q_OVERFLOW:
+                events.append((path, mask, name))
+        return events
+
+    def close(self):
+        if self.__fd >= 0:
+            os.close(self.__fd)
+            self.__fd = -1
+
+
+class DropFolderWatcher(object):
+    """Watch a source directory and insert its new files into the repository.
+
+    A file is inserted when it has been closed after writing, or moved into
+    the directory, and it has not changed for settle seconds. A file which is
+    created or written to is not ready until it's closed, however long the
+    writer stalls. Hidden files (name starting with '.') are taken as partial
+    downloads and ignored.
+
+    Files already inserted, or found when the watch started, are remembered,
+    so they are not inserted again when the events queue overflows and the
+    directory is rescanned.
+
+    Inserts go through RepositoryManager.insert_file, so the content check,
+    logging and results are the same as in a batch import.
+
+    :param repository: Repository
+    :param path: str. Directory to watch, recursively.
+    :param settle: float. Optional. Seconds without changes before a file is
+        inserted.
+    :param exclude_ext: list. Optional. Extensions to ignore.
+    :param factory: dict. Optional. See SourceFilesManger.
+    :param skip_unsupported: bool. Optional. See SourceFilesManger.
+    :param date_from_name: DateFromName. Optional. See SourceFilesManger.
+    :param overwrite, alternate_names, dry_run: See Repository.insert.
+    """
+    def __init__(self, repository, path, settle=DEFAULT_SETTLE,
+                 exclude_ext=None, factory=None, skip_unsupported=False,
+                 date_from_name=None, overwrite=False, alternate_names=False,
+                 dry_run=False):
+        if not os.path.isdir(path):
+            raise ValueError(
+                "Given source is not a directory: {}".format(path))
+
+        self.__path = path
+        self.__settle = settle
+        self.__exclude_ext = [ext.lower() for ext in exclude_ext or []]
+        self.__factory = factory
+        self.__skip_unsupported = skip_unsupported
+        self.__date_from_name = date_from_name
+        self.__insert_kwargs = dict(overwrite=overwrite,
+                                    alternate_names=alternate_names,
+                                    dry_run=dry_run)
+
+        self.__manager = RepositoryManager(repository, None)
+        self.__inotify = None
+        self.__running = False
+
+        # Files waiting to settle:
+        #   {fpath: (size, time of last change, closed after last write)}
+        self.__pending = {}
+
+        # Files inserted (or tried to) and files found when the watch started.
+        self.__seen = set()
+
+    @property
+    def manager(self):
+        """RepositoryManager with the insert results."""
+        return self.__manager
+
+    def pending(self):
+        """Paths of the files waiting to be inserted."""
+        return sorted(self.__pending)
+
+    def start(self, import_existing=False):
+        """Add the inotify watches.
+
+        If import_existing is True, files already in the directory are queued
+        to be inserted.
+        """
+        self.__inotify = Inotify()
+        self.__watch_tree(self.__path, queue_files=import_existing,
+                          mark_seen=not import_existing)
+
+    def stop(self):
+        self.__running = False
+        if self.__inotify is not None:
+            self.__inotify.close()
+            self.__inotify = None
+
+    def run(self, import_existing=False):
+        """Watch and insert files until stop() is called or KeyboardInterrupt."""
+        if self.__inotify is None:
+            self.start(import_existing=import_existing)
+        self.__running = True
+        try:
+            while self.__running:
+                self.poll(timeout=self.__settle / 2.0)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def poll(self, timeout=0):
+        """Process pending events and insert settled files.
+
+        Return the list of file paths inserted (or tried to) in this call.
+        """
+        for dir_path, mask, name in self.__inotify.read(timeout):
+            if mask & IN_Q_OVERFLOW:
+                # Events have been lost. Rescan to not miss new files.
+                self.__watch_tree(self.__path, queue_files=True)
+                continue
+
+            fpath = os.path.join(dir_path, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files may have been written before the watch is added.
+                    self.__watch_tree(fpath, queue_files=True)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self.__pending.pop(fpath, None)
+                self.__seen.discard(fpath)
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.__queue(fpath, closed=True)
+            elif mask & (IN_CREATE | IN_MODIFY):
+                # Still being written.
+                self.__queue(fpath, closed=False)
+
+        inserted = [fpath for fpath in self.__settled() if self.__insert(fpath)]
+        if inserted:
+            # Staged files are committed every poll, not every full batch.
+            self.__manager.repo.commit()
+        return inserted
+
+    def __watch_tree(self, path, queue_files, mark_seen=False):
+        for dir_path, dir_names, file_names in os.walk(path):
+            try:
+                self.__inotify.add_watch(dir_path)
+            except OSError, ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+            for fname in file_names:
+                fpath = os.path.join(dir_path, fname)
+                if mark_seen:
+                    self.__seen.add(fpath)
+                elif (queue_files and fpath not in self.__seen and
+                        fpath not in self.__pending):
+                    # No events for it: taken as complete once it settles.
+                    # A write while it settles makes it not ready again.
+                    self.__queue(fpath, closed=True)
+
+    def __queue(self, fpath, closed):
+        fname = os.path.basename(fpath)
+        if fname.startswith('.'):
+            return
+        if os.path.splitext(fname)[1][1:].lower() in self.__exclude_ext:
+            return
+        # Any event restarts the settle time. A written file is new content.
+        self.__seen.discard(fpath)
+        self.__pending[fpath] = (None, time.time(), closed)
+
+    def __settled(self):
+        """Pop and return the closed pending files which haven't changed."""
+        now = time.time()
+        settled = []
+        for fpath, (size, changed, closed) in self.__pending.items():
+            try:
+                current_size = os.path.getsize(fpath)
+            except OSError:
+                # Removed or renamed before settling.
+                del self.__pending[fpath]
+                continue
+            if current_size != size:
+                self.__pending[fpath] = (current_size, now, closed)
+            elif closed and now - changed >= self.__settle:
+                del self.__pending[fpath]
+                settled.append(fpath)
+        return sorted(settled)
+
+    def __source_file(self, fpath):
+        file_type = sniff_file_type(fpath)
+        if self.__date_from_name is not None and file_type is not None:
+            date = self.__date_from_name.parse(
+                os.path.splitext(os.path.basename(fpath))[0])
+            if date is not None:
+                return SourceFileDateFromName(
+                    fpath, date_from_name=self.__date_from_name,
+                    date_create=date, file_type=file_type)
+
+        if (self.__skip_unsupported and
+                file_type_handler(file_type, self.__factory) is None):
+            return None
+        return source_file_factory(fpath, self.__factory, file_type=file_type)
+
+    def __insert(self, fpath):
+        self.__seen.add(fpath)
+        try:
+            source_file = self.__source_file(fpath)
+        except ValueError:
+            # Removed between settling and loading.
+            return False
+        if source_file is None:
+            return False
+        self.__manager.insert_file(source_file, **self.__insert_kwargs)
+        return True